@@ -1,74 +1,371 @@
 import json
+import logging
 import datetime
-
-import cloudstorage as gcs
+import functools
 
 from techsubs import subreddits
-from techsubs.bucket_populator.common import API_BUCKET_NAME, API_BUCKET_PATH
+from techsubs.bucket_populator.common import API_BUCKET_NAME, \
+    API_BUCKET_PATH, run_concurrently
+from techsubs.bucket_populator.uploader import upload_documents, \
+    get_uploaded_document
 from techsubs.exceptions import NotFoundError
+from techsubs.metrics.backends.base import one_of
+from techsubs.metrics.common import build_aggregation, get_environment
+from techsubs.metrics.recent_history import get_rolling_stats, get_hour, \
+    get_dirty_subreddits, clear_dirty_subreddits
 from techsubs.metrics.metric_defines import SubRedditSubscribers, \
     SubRedditAccountsActive, SubRedditNewPostCount
+from techsubs.utils import chunked
+
+# The most sub-Reddits to put in a single Google Metrics query's filter.
+QUERY_SUBREDDITS_PER_CHUNK = 25
+# How many Google Metrics queries to have in flight at once.
+MAX_CONCURRENT_QUERIES = 8
 
 
 def generate_and_upload(category):
-    overview_json = _generate_json(category)
-    uri = '/{bucket_name}/{bucket_path}/category/{category}/overview'.format(
+    upload_documents({
+        _get_category_overview_uri(category): _generate_doc(category),
+    })
+
+
+def generate_and_upload_all(only_dirty=True):
+    """
+    Generates and uploads category overviews, plus the overview of all
+    sub-Reddits, in one pass. Each sub-Reddit's stats are computed once
+    and shared by every document it appears in, no matter how many
+    categories it belongs to.
+
+    :param bool only_dirty: If True, only the categories with at least one
+        sub-Reddit that got new points since the last upload are
+        regenerated, and only their sub-Reddits' stats are computed. The
+        overview of all sub-Reddits lists every dirty sub-Reddit, so it's
+        rebuilt on each run. Its other records are carried over from the
+        copy we last uploaded, rather than computed again.
+    """
+    all_slugs = list(subreddits.CATALOG.keys())
+    environment = get_environment()
+    # Read before generating, so that anything that comes in while we work
+    # stays dirty for next time.
+    dirty_versions = get_dirty_subreddits(all_slugs, environment)
+    if only_dirty and not dirty_versions:
+        logging.info("No dirty sub-Reddits. Skipping regeneration.")
+        return
+
+    categories = []
+    for category in subreddits.CATEGORIES.keys():
+        category_slugs = [
+            subreddit['slug'] for subreddit in
+            subreddits.get_subreddits_in_category(category)]
+        if not only_dirty or any(
+                slug in dirty_versions for slug in category_slugs):
+            categories.append((category, category_slugs))
+
+    all_overview_uri = _get_all_subreddits_overview_uri()
+    carried_over_stats = {}
+    if only_dirty:
+        # This has to be read after the dirty flags. A run that cleared
+        # any has already uploaded its copy of this document.
+        carried_over_stats = _get_uploaded_stats_by_slug(all_overview_uri)
+    stale_slugs = set(dirty_versions)
+    for _, category_slugs in categories:
+        stale_slugs.update(category_slugs)
+    stale_slugs.update(
+        slug for slug in all_slugs if slug not in carried_over_stats)
+
+    stats_by_slug = {slug: slug_stats for slug, slug_stats
+                     in carried_over_stats.items() if slug not in stale_slugs}
+    stats_by_slug.update(_get_subreddit_stats_by_slug(
+        [slug for slug in all_slugs if slug in stale_slugs]))
+    documents = {
+        _get_category_overview_uri(category): _build_overview_doc(
+            category_slugs, stats_by_slug)
+        for category, category_slugs in categories}
+    documents[all_overview_uri] = _build_overview_doc(
+        all_slugs, stats_by_slug)
+    # Documents whose contents came out the same as before are skipped.
+    upload_documents(documents)
+    clear_dirty_subreddits(dirty_versions, environment)
+
+
+def _get_uploaded_stats_by_slug(uri):
+    """
+    :param str uri: The GCS URI of an uploaded overview document.
+    :rtype: dict
+    :returns: A dict of sub-Reddit slugs to the stat dicts in the document.
+        Empty if it hasn't been uploaded yet.
+    """
+    overview_doc = get_uploaded_document(uri) or {}
+    return {subreddit_stats['subreddit']: subreddit_stats
+            for subreddit_stats in overview_doc.get('records', [])}
+
+
+def _get_category_overview_uri(category):
+    """
+    :param str category: The category the overview is for.
+    :rtype: str
+    :returns: The GCS URI of the category's overview document.
+    """
+    return '/{bucket_name}/{bucket_path}/category/{category}/overview'.format(
         bucket_name=API_BUCKET_NAME, bucket_path=API_BUCKET_PATH,
         category=category)
-    gcs_fobj = gcs.open(
-        filename=uri, mode='w',
-        content_type='application/json',
-        options={'Cache-Control': 'public, max-age=60'})
-    gcs_fobj.write(overview_json)
-    gcs_fobj.close()
+
+
+def _get_all_subreddits_overview_uri():
+    """
+    :rtype: str
+    :returns: The GCS URI of the overview document for every sub-Reddit.
+    """
+    return '/{bucket_name}/{bucket_path}/subreddits/overview'.format(
+        bucket_name=API_BUCKET_NAME, bucket_path=API_BUCKET_PATH)
 
 
 def _generate_json(category):
+    return _render_overview_json(_generate_doc(category))
+
+
+def _generate_doc(category):
+    """
+    :param str category: The category to generate the overview for.
+    :rtype: dict
+    :returns: The category's overview document, minus its generatedTime.
+    :raises: NotFoundError if the category doesn't exist.
+    """
     if not subreddits.is_valid_subreddit_category(category):
         raise NotFoundError('Invalid Subreddit category.')
 
     cat_subreddits = subreddits.get_subreddits_in_category(category)
-    retval = {
-        'generatedTime': datetime.datetime.now().isoformat(),
-        'records': [],
-        'queryRecordCount': len(cat_subreddits),
-        'totalRecordCount': len(cat_subreddits),
-    }
+    subreddit_slugs = [subreddit['slug'] for subreddit in cat_subreddits]
+    return _build_overview_doc(
+        subreddit_slugs, _get_subreddit_stats_by_slug(subreddit_slugs))
 
-    for subreddit in cat_subreddits:
-        retval['records'].append(
-            _query_and_return_subreddit_stats(subreddit['slug']))
-    return json.dumps(retval)
 
+def _generate_all_json():
+    """
+    :rtype: str
+    :returns: The overview JSON document for every sub-Reddit.
+    """
+    all_slugs = list(subreddits.CATALOG.keys())
+    return _render_overview_json(_build_overview_doc(
+        all_slugs, _get_subreddit_stats_by_slug(all_slugs)))
 
-def _query_and_return_subreddit_stats(subreddit_slug):
-    end_time = datetime.datetime.now()
-    start_time = end_time - datetime.timedelta(hours=24)
-    metric_label_filters = {"subreddit": subreddit_slug}
 
-    subscriber_stats = _query_and_return_subscriber_stats(
-        start_time, end_time, metric_label_filters)
-    active_accounts_stats = _query_and_return_active_account_stats(
-        start_time, end_time, metric_label_filters)
-    post_stats = _query_and_return_post_stats(
-        start_time, end_time, metric_label_filters)
+def _render_overview_json(overview_doc):
+    """
+    :param dict overview_doc: An overview document, from
+        :py:func:`_build_overview_doc`.
+    :rtype: str
+    :returns: The overview JSON document, stamped with its generatedTime.
+    """
+    overview_doc['generatedTime'] = datetime.datetime.now().isoformat()
+    return json.dumps(overview_doc)
+
 
+def _build_overview_doc(subreddit_slugs, stats_by_slug):
+    """
+    :param list subreddit_slugs: The sub-Reddits in the document, in the
+        order they should be listed.
+    :param dict stats_by_slug: A dict of sub-Reddit slugs to stat dicts.
+        May include others besides ``subreddit_slugs``.
+    :rtype: dict
+    :returns: An overview document, minus its generatedTime.
+    """
+    records = [stats_by_slug[slug] for slug in subreddit_slugs
+               if slug in stats_by_slug]
     return {
-        'subreddit': subreddit_slug,
-        'accounts_active': active_accounts_stats['24_hour_peak'],
-        'new_subscribers': subscriber_stats['24_hour_growth'],
-        'total_subscribers': subscriber_stats['current_total'],
-        'new_posts': post_stats['24_hour_growth']
+        'records': records,
+        # Any sub-Reddits whose stats couldn't be queried are left out.
+        'queryRecordCount': len(records),
+        'totalRecordCount': len(subreddit_slugs),
     }
 
 
-def _query_and_return_active_account_stats(start_time, end_time,
-                                           metric_label_filters):
-    results = SubRedditAccountsActive.query_gauge(
-        start_time, end_time, metric_label_filters=metric_label_filters)
+def _get_subreddit_stats_by_slug(subreddit_slugs):
+    """
+    :param list subreddit_slugs: The sub-Reddits to get stats for.
+    :rtype: dict
+    :returns: A dict of sub-Reddit slugs to stat dicts. Sub-Reddits whose
+        stats couldn't be queried are left out.
+    """
+    return {subreddit_stats['subreddit']: subreddit_stats
+            for subreddit_stats in
+            _query_and_return_subreddit_stats(subreddit_slugs)}
+
+
+def _query_and_return_subreddit_stats(subreddit_slugs):
+    """
+    Pulls the stats for all of the sub-Reddits in one go. Most come from
+    the rolling stats that the scanners keep up to date. Any sub-Reddits
+    that those don't fully cover yet are queried from Google Metrics,
+    concurrently.
 
+    :param list subreddit_slugs: The sub-Reddits to return stats for.
+    :rtype: generator
+    :returns: A generator of per-sub-Reddit stat dicts, in the same order as
+        ``subreddit_slugs``. Sub-Reddits whose queries failed are skipped.
+    """
+    period = datetime.timedelta(hours=24)
+    end_time = datetime.datetime.now()
+    start_time = end_time - period
+
+    pushed_stats = _calc_stats_from_rolling_stats(
+        subreddit_slugs, start_time, end_time)
+    missing_slugs = [slug for slug in subreddit_slugs
+                     if slug not in pushed_stats]
+    query_stats = {}
+    if missing_slugs:
+        query_stats = _query_stats_from_metrics(
+            missing_slugs, start_time, end_time, period)
+
+    for subreddit_slug in subreddit_slugs:
+        slug_stats = pushed_stats.get(subreddit_slug) or \
+            query_stats.get(subreddit_slug)
+        if slug_stats is None:
+            continue
+        subscriber_stats, active_accounts_stats, post_stats = slug_stats
+        yield {
+            'subreddit': subreddit_slug,
+            'accounts_active': active_accounts_stats['24_hour_peak'],
+            'new_subscribers': subscriber_stats['24_hour_growth'],
+            'total_subscribers': subscriber_stats['current_total'],
+            'new_posts': post_stats['24_hour_growth']
+        }
+
+
+def _calc_stats_from_rolling_stats(subreddit_slugs, start_time, end_time):
+    """
+    :param list subreddit_slugs: The sub-Reddits to return stats for.
+    :param datetime.datetime start_time: Beginning of the window (exclusive).
+    :param datetime.datetime end_time: End of the window.
+    :rtype: dict
+    :returns: A dict of sub-Reddit slugs to (subscriber_stats,
+        active_accounts_stats, post_stats) tuples. Only sub-Reddits that
+        the rolling stats cover the whole window for are included.
+    """
+    # Like Google Metrics queries, the window doesn't include its start, so
+    # the hour that start_time falls in is left out.
+    start_hour = get_hour(start_time) + 1
+    end_hour = get_hour(end_time)
+
+    rolling_stats = get_rolling_stats(subreddit_slugs, get_environment())
+
+    stats = {}
+    for subreddit_slug in subreddit_slugs:
+        slug_buffers = rolling_stats.get(subreddit_slug, {})
+        rings = [slug_buffers.get(metric.metric_name) for metric in
+                 (SubRedditSubscribers, SubRedditAccountsActive,
+                  SubRedditNewPostCount)]
+        if not all(ring and ring.covers(start_hour) for ring in rings):
+            continue
+        subscriber_ring, active_accounts_ring, post_ring = rings
+
+        oldest, newest = subscriber_ring.get_oldest_and_newest(
+            start_hour, end_hour)
+        stats[subreddit_slug] = (
+            {
+                'current_total': newest or 0,
+                '24_hour_growth': (newest or 0) - (oldest or 0),
+            },
+            {
+                '24_hour_peak': active_accounts_ring.get_peak(
+                    start_hour, end_hour),
+            },
+            {
+                '24_hour_growth': post_ring.get_total(start_hour, end_hour),
+            },
+        )
+    return stats
+
+
+def _query_stats_from_metrics(subreddit_slugs, start_time, end_time, period):
+    """
+    The sub-Reddits are queried in chunks, with every chunk's queries run
+    concurrently. A chunk whose queries fail only loses its own
+    sub-Reddits.
+
+    :param list subreddit_slugs: The sub-Reddits to return stats for.
+    :param datetime.datetime start_time: Beginning of the interval to query.
+    :param datetime.datetime end_time: End of the interval to query.
+    :param datetime.timedelta period: The length of the interval.
+    :rtype: dict
+    :returns: A dict of sub-Reddit slugs to (subscriber_stats,
+        active_accounts_stats, post_stats) tuples. Sub-Reddits whose
+        queries failed are left out.
+    :raises: The last error encountered, if every chunk failed.
+    """
+    slug_chunks = list(chunked(subreddit_slugs, QUERY_SUBREDDITS_PER_CHUNK))
+    chunk_queries = [
+        _build_chunk_queries(slug_chunk, start_time, end_time, period)
+        for slug_chunk in slug_chunks]
+    results = run_concurrently(
+        [query for queries in chunk_queries for query in queries],
+        MAX_CONCURRENT_QUERIES)
+
+    stats = {}
+    last_error = None
+    for slug_chunk, queries in zip(slug_chunks, chunk_queries):
+        chunk_results = results[:len(queries)]
+        results = results[len(queries):]
+        chunk_errors = [error for _, error in chunk_results if error]
+        if chunk_errors:
+            logging.error(
+                "Leaving out sub-Reddits whose stats failed to query: %s",
+                ', '.join(slug_chunk))
+            last_error = chunk_errors[-1]
+            continue
+
+        subscriber_points, active_accounts_points, post_points = [
+            result for result, _ in chunk_results]
+        for subreddit_slug in slug_chunk:
+            stats[subreddit_slug] = (
+                _calc_subscriber_stats(
+                    subscriber_points.get(subreddit_slug, [])),
+                _calc_active_account_stats(
+                    active_accounts_points.get(subreddit_slug, [])),
+                _calc_post_stats(post_points.get(subreddit_slug, [])),
+            )
+
+    if not stats and last_error is not None:
+        raise last_error
+    return stats
+
+
+def _build_chunk_queries(subreddit_slugs, start_time, end_time, period):
+    """
+    :param list subreddit_slugs: The sub-Reddits to query together.
+    :param datetime.datetime start_time: Beginning of the interval to query.
+    :param datetime.datetime end_time: End of the interval to query.
+    :param datetime.timedelta period: The length of the interval.
+    :rtype: list
+    :returns: No-argument callables that query the subscriber, active
+        account, and new post points, in that order. Each returns a dict of
+        sub-Reddit slugs to points.
+    """
+    metric_label_filters = {"subreddit": one_of(subreddit_slugs)}
+    environment = get_environment()
+    # Gauges can't be aligned with ALIGN_DELTA, so we still need the raw
+    # points to find the oldest and youngest subscriber counts.
+    return [
+        functools.partial(
+            SubRedditSubscribers.query_gauge_by_label,
+            'subreddit', start_time, end_time, environment=environment,
+            metric_label_filters=metric_label_filters),
+        functools.partial(
+            SubRedditAccountsActive.query_gauge_by_label,
+            'subreddit', start_time, end_time, environment=environment,
+            metric_label_filters=metric_label_filters,
+            aggregation=build_aggregation(period, 'ALIGN_MAX')),
+        functools.partial(
+            SubRedditNewPostCount.query_gauge_by_label,
+            'subreddit', start_time, end_time, environment=environment,
+            metric_label_filters=metric_label_filters,
+            aggregation=build_aggregation(period, 'ALIGN_SUM')),
+    ]
+
+
+def _calc_active_account_stats(points):
     peak_count = 0
-    for point in results:
+    for point in points:
         pval = point['value']
         if pval > peak_count:
             peak_count = pval
@@ -78,31 +375,31 @@ def _query_and_return_active_account_stats(start_time, end_time,
     }
 
 
-def _query_and_return_subscriber_stats(start_time, end_time, metric_label_filters):
-    results = SubRedditSubscribers.query_gauge(
-        start_time, end_time, metric_label_filters=metric_label_filters)
-
+def _calc_subscriber_stats(points):
     oldest_point = None
     youngest_point = None
-    for point in results:
+    for point in points:
         ptime = point['time']
         if oldest_point is None or ptime < oldest_point['time']:
             oldest_point = point
         if youngest_point is None or ptime > youngest_point['time']:
             youngest_point = point
 
+    if youngest_point is None:
+        # Nothing has been reported for this sub-Reddit yet.
+        return {
+            'current_total': 0,
+            '24_hour_growth': 0,
+        }
     return {
         'current_total': youngest_point['value'],
         '24_hour_growth': youngest_point['value'] - oldest_point['value'],
     }
 
 
-def _query_and_return_post_stats(start_time, end_time, metric_label_filters):
-    results = SubRedditNewPostCount.query_gauge(
-        start_time, end_time, metric_label_filters=metric_label_filters)
-
+def _calc_post_stats(points):
     total_new = 0
-    for point in results:
+    for point in points:
         total_new += point['value']
 
     return {
@@ -1,3 +1,10 @@
+import time
+import logging
+import threading
+
+import flask
+from google.appengine.api import taskqueue
+
 from techsubs import app
 
 
@@ -6,3 +13,65 @@ if app.config['IS_PRODUCTION']:
     API_BUCKET_PATH = 'api'
 else:
     API_BUCKET_PATH = 'dev/api'
+# Scans that finish within the same window of this many seconds share a
+# single regeneration of the overview documents, at the end of the window.
+POPULATION_DEBOUNCE_SECONDS = 120
+
+
+def enqueue_debounced_population():
+    """
+    Regenerates the overview documents shortly after new stats come in.
+    Call this whenever a scan finishes. A whole scan cycle's worth of
+    batches gets folded into one regeneration, since each window's task is
+    named, and the task queue won't take a second one with the same name.
+    """
+    now = time.time()
+    window = int(now // POPULATION_DEBOUNCE_SECONDS)
+    window_end = (window + 1) * POPULATION_DEBOUNCE_SECONDS
+    try:
+        taskqueue.add(
+            url=flask.url_for('json-all-overviews-json'),
+            name='populate-all-overviews-{}'.format(window),
+            countdown=int(window_end - now) + 1,
+            queue_name='bucket-populator-workers')
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        # Another scan in this window already has one queued up.
+        pass
+
+
+def run_concurrently(funcs, max_threads):
+    """
+    Calls each function on a bounded pool of threads, and waits for them
+    all to finish. Use this to overlap slow, blocking calls like Google
+    Metrics queries. Each thread builds its own Google Metrics client.
+
+    :param list funcs: The no-argument callables to call.
+    :param int max_threads: The most calls to have running at once.
+    :rtype: list
+    :returns: A list of tuples in the form of: result, error. These are in
+        the same order as ``funcs``. error is None unless the call raised,
+        in which case result is None. Errors are logged, but never raised.
+    """
+    results = [None] * len(funcs)
+    func_indices = iter(range(len(funcs)))
+    indices_lock = threading.Lock()
+
+    def worker():
+        while True:
+            with indices_lock:
+                index = next(func_indices, None)
+            if index is None:
+                return
+            try:
+                results[index] = (funcs[index](), None)
+            except Exception as exc:
+                logging.exception("Concurrent call failed.")
+                results[index] = (None, exc)
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(max_threads, len(funcs)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
@@ -0,0 +1,225 @@
+"""
+Uploads generated JSON documents to Google Storage. Each document's content
+hash is kept in its object metadata, so a document that hasn't changed since
+the last upload is skipped. Changed documents go up concurrently.
+"""
+import json
+import hashlib
+import logging
+import datetime
+import functools
+
+import cloudstorage as gcs
+from google.appengine.ext import ndb
+
+from techsubs.bucket_populator.common import API_BUCKET_NAME, \
+    API_BUCKET_PATH, run_concurrently
+from techsubs.models import DocumentManifest
+
+# Object metadata keys for a document's content hash and version.
+CONTENT_HASH_METADATA_KEY = 'x-goog-meta-content-hash'
+VERSION_METADATA_KEY = 'x-goog-meta-version'
+# Object metadata key for the manifest's DocumentManifest revision.
+REVISION_METADATA_KEY = 'x-goog-meta-revision'
+# How many documents to stat and upload at once.
+MAX_CONCURRENT_UPLOADS = 8
+# Lists every document's content hash and version.
+MANIFEST_URI = '/{bucket_name}/{bucket_path}/manifest'.format(
+    bucket_name=API_BUCKET_NAME, bucket_path=API_BUCKET_PATH)
+
+
+def upload_documents(documents):
+    """
+    Uploads any documents that have changed since they were last uploaded,
+    then updates the manifest to match.
+
+    Each document that goes up gets its generatedTime stamped. That field
+    is left out of the content hash, so that a document isn't considered
+    changed just because it was regenerated.
+
+    :param dict documents: A dict of GCS URIs to document dicts.
+    :rtype: list
+    :returns: The URIs of the documents that were uploaded.
+    :raises: The last upload error, if any documents failed to upload. The
+        manifest is still updated for the ones that made it.
+    """
+    uris = sorted(documents)
+    results = run_concurrently(
+        [functools.partial(_upload_document_if_changed, uri, documents[uri])
+         for uri in uris],
+        MAX_CONCURRENT_UPLOADS)
+
+    manifest_entries = {}
+    uploaded_uris = []
+    last_error = None
+    for uri, (result, error) in zip(uris, results):
+        if error is not None:
+            last_error = error
+            continue
+        entry, was_uploaded = result
+        manifest_entries[uri] = entry
+        if was_uploaded:
+            uploaded_uris.append(uri)
+    logging.info(
+        "Uploaded %d of %d documents.", len(uploaded_uris), len(uris))
+
+    if uploaded_uris:
+        _update_manifest(manifest_entries)
+    if last_error is not None:
+        raise last_error
+    return uploaded_uris
+
+
+def get_content_hash(document):
+    """
+    :param dict document: The document to hash.
+    :rtype: str
+    :returns: A hash of everything in the document but its generatedTime.
+    """
+    hashed_fields = {key: value for key, value in document.items()
+                     if key != 'generatedTime'}
+    document_json = json.dumps(hashed_fields, sort_keys=True)
+    return hashlib.sha1(document_json.encode('utf-8')).hexdigest()
+
+
+def get_uploaded_document(uri):
+    """
+    :param str uri: The GCS URI to read.
+    :rtype: dict or None
+    :returns: The document as it was last uploaded, or None if it hasn't
+        been uploaded yet.
+    """
+    try:
+        gcs_fobj = gcs.open(uri)
+    except gcs.NotFoundError:
+        return None
+    document = json.loads(gcs_fobj.read())
+    gcs_fobj.close()
+    return document
+
+
+def _upload_document_if_changed(uri, document):
+    """
+    :param str uri: The GCS URI to upload to.
+    :param dict document: The document to upload.
+    :rtype: tuple
+    :returns: Tuple in the form of: manifest_entry, was_uploaded
+    """
+    content_hash = get_content_hash(document)
+    stored_hash, stored_version = _get_stored_hash_and_version(uri)
+    if content_hash == stored_hash:
+        return {'hash': content_hash, 'version': stored_version}, False
+
+    version = stored_version + 1
+    document = dict(
+        document, generatedTime=datetime.datetime.now().isoformat())
+    _upload_json(uri, json.dumps(document), {
+        CONTENT_HASH_METADATA_KEY: content_hash,
+        VERSION_METADATA_KEY: str(version),
+    })
+    return {'hash': content_hash, 'version': version}, True
+
+
+def _get_stored_hash_and_version(uri):
+    """
+    :param str uri: The GCS URI to look up.
+    :rtype: tuple
+    :returns: Tuple in the form of: content_hash, version. These are None
+        and 0 if the object doesn't exist, or predates content hashing.
+    """
+    metadata = _get_stored_metadata(uri)
+    return (metadata.get(CONTENT_HASH_METADATA_KEY),
+            int(metadata.get(VERSION_METADATA_KEY, 0)))
+
+
+def _get_stored_metadata(uri):
+    """
+    :param str uri: The GCS URI to look up.
+    :rtype: dict
+    :returns: The object's metadata, with lower-cased keys. Empty if the
+        object doesn't exist.
+    """
+    try:
+        file_stat = gcs.stat(uri)
+    except gcs.NotFoundError:
+        return {}
+    return {key.lower(): value
+            for key, value in (file_stat.metadata or {}).items()}
+
+
+def _update_manifest(manifest_entries):
+    """
+    Merges new entries into the manifest, then publishes it. Documents
+    that weren't part of this upload keep their existing entries.
+
+    Concurrent populators can finish their uploads in any order, so ours
+    may land on top of a newer revision. After uploading, we check for
+    that and publish the newer revision ourselves, until the manifest in
+    Google Storage is the latest one.
+
+    :param dict manifest_entries: A dict of GCS URIs to dicts with the
+        document's hash and version.
+    """
+    documents, revision = _merge_manifest_entries(manifest_entries)
+    while True:
+        # Whoever published a revision at least as new as ours also makes
+        # sure that nothing newer than theirs gets lost.
+        published_revision = int(
+            _get_stored_metadata(MANIFEST_URI).get(REVISION_METADATA_KEY, 0))
+        if published_revision >= revision:
+            return
+
+        manifest = {
+            'generatedTime': datetime.datetime.now().isoformat(),
+            'revision': revision,
+            'documents': documents,
+        }
+        _upload_json(MANIFEST_URI, json.dumps(manifest),
+                     {REVISION_METADATA_KEY: str(revision)})
+
+        # Skip the context cache, it would just hand back our own merge.
+        latest = DocumentManifest.get_by_id(MANIFEST_URI, use_cache=False)
+        if latest.revision <= revision:
+            return
+        documents, revision = latest.documents, latest.revision
+
+
+@ndb.transactional
+def _merge_manifest_entries(manifest_entries):
+    """
+    :param dict manifest_entries: A dict of GCS URIs to dicts with the
+        document's hash and version.
+    :rtype: tuple
+    :returns: Tuple in the form of: documents, revision. These are the
+        merged manifest entries and the revision they were saved as.
+    """
+    manifest = DocumentManifest.get_by_id(MANIFEST_URI) or \
+        DocumentManifest(id=MANIFEST_URI)
+    documents = manifest.documents or {}
+    for uri, entry in manifest_entries.items():
+        existing_entry = documents.get(uri)
+        # A slower run can finish after a faster one that uploaded a newer
+        # version of the same document.
+        if existing_entry is None or \
+                entry['version'] >= existing_entry['version']:
+            documents[uri] = entry
+    manifest.documents = documents
+    manifest.revision += 1
+    manifest.put()
+    return documents, manifest.revision
+
+
+def _upload_json(uri, json_str, options=None):
+    """
+    :param str uri: The GCS URI to upload to.
+    :param str json_str: The JSON document to upload.
+    :param dict options: Extra headers, like object metadata, to upload with.
+    """
+    gcs_options = {'Cache-Control': 'public, max-age=60'}
+    gcs_options.update(options or {})
+    gcs_fobj = gcs.open(
+        filename=uri, mode='w',
+        content_type='application/json',
+        options=gcs_options)
+    gcs_fobj.write(json_str)
+    gcs_fobj.close()
@@ -14,3 +14,16 @@ def populate_flask_config(app):
         app.config['IS_PRODUCTION'] = False
     else:
         app.config['IS_PRODUCTION'] = True
+
+    # Where metrics are stored. One of 'cloud_monitoring' or 'sqlite'. See
+    # techsubs.metrics.backends.
+    app.config['METRICS_BACKEND'] = os.environ.get(
+        'TECHSUBS_METRICS_BACKEND', 'cloud_monitoring')
+    app.config['METRICS_SQLITE_PATH'] = os.environ.get(
+        'TECHSUBS_METRICS_SQLITE_PATH', 'techsubs-metrics.sqlite3')
+
+    # When on, accounts_active is sampled every few minutes and rolled up
+    # into hourly points, instead of read once by the hourly scan. See
+    # techsubs.sr_scanner.basic_stats.
+    app.config['SAMPLE_ACCOUNTS_ACTIVE'] = os.environ.get(
+        'TECHSUBS_SAMPLE_ACCOUNTS_ACTIVE', '') == '1'
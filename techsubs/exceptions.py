@@ -19,3 +19,34 @@ class BaseException(Exception):
 
 class NotFoundError(BaseException):
     status_code = 404
+
+
+class RedditAPIError(BaseException):
+    """
+    Raised when Reddit's API responds with something other than a 200.
+    """
+    status_code = 502
+
+
+class RedditRateLimitedError(RedditAPIError):
+    """
+    Raised when Reddit keeps rate limiting us, even after backing off.
+    """
+    status_code = 503
+
+
+class MetricWriteError(BaseException):
+    """
+    Raised when some of the time series in a
+    :py:class:`techsubs.metrics.common.MetricBatch` couldn't be written.
+    """
+    status_code = 502
+
+    def __init__(self, message, failures=None, **kwargs):
+        """
+        :param str message: What went wrong.
+        :param list failures: The batch's
+            :py:class:`techsubs.metrics.common.TimeSeriesWriteFailure` tuples.
+        """
+        super(MetricWriteError, self).__init__(message, **kwargs)
+        self.failures = failures or []
@@ -0,0 +1,47 @@
+"""
+Storage backends for our metrics.
+:py:class:`techsubs.metrics.common.BaseMetric` hands all of its reads and
+writes to whichever backend the METRICS_BACKEND config value selects:
+
+* ``cloud_monitoring``: Google Cloud Monitoring (the default).
+* ``sqlite``: A local SQLite database at METRICS_SQLITE_PATH. Handy for
+  running or load-testing things offline.
+"""
+import threading
+
+from techsubs import app
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_metrics_backend():
+    """
+    :rtype: techsubs.metrics.backends.base.BaseMetricsBackend
+    :returns: The configured metrics backend.
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = _create_metrics_backend(app.config)
+    return _backend
+
+
+def _create_metrics_backend(config):
+    """
+    :param dict config: The Flask app's config.
+    :rtype: techsubs.metrics.backends.base.BaseMetricsBackend
+    :raises: ValueError if METRICS_BACKEND isn't a backend we know about.
+    """
+    backend_name = config['METRICS_BACKEND']
+    # These are imported here so that we only pull in what we use.
+    if backend_name == 'cloud_monitoring':
+        from techsubs.metrics.backends.cloud_monitoring import \
+            CloudMonitoringBackend
+        return CloudMonitoringBackend()
+    elif backend_name == 'sqlite':
+        from techsubs.metrics.backends.sqlite import SQLiteBackend
+        return SQLiteBackend(config['METRICS_SQLITE_PATH'])
+    else:
+        raise ValueError('Un-implemented metrics backend: %s' % backend_name)
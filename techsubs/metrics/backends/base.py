@@ -0,0 +1,104 @@
+"""
+The interface that every metrics backend implements, along with the
+backend-neutral filter and aggregation specs that get passed to them.
+"""
+from collections import namedtuple
+
+# Which time series a query should match. metric_type is the full metric
+# type (custom.googleapis.com/...), and labels is a dict of label keys to
+# either a value or a one_of set of values.
+MetricFilter = namedtuple('MetricFilter', ['metric_type', 'labels'])
+
+# How to aggregate the points a query matches. alignment_period is in
+# seconds, and the rest use the Monitoring API's names. See
+# techsubs.metrics.common.build_aggregation.
+Aggregation = namedtuple('Aggregation', [
+    'alignment_period', 'per_series_aligner', 'cross_series_reducer',
+    'group_by_fields'])
+
+
+class one_of(frozenset):
+    """
+    Wrap a metric label filter value in this to match any of several
+    values, rather than exactly one.
+    """
+
+
+class BaseMetricsBackend(object):
+    """
+    Sub-class this to store metrics somewhere new. Time series and points
+    are passed around as dicts shaped like the Monitoring v3 API's TimeSeries
+    and Point, so that everything above the backend stays the same.
+    """
+    # The most time series to send per write_timeseries() call.
+    max_write_batch_size = 200
+
+    def create_metric_descriptor(self, descriptor):
+        """
+        :param dict descriptor: A MetricDescriptor dict.
+        :returns: The created descriptor.
+        """
+        raise NotImplementedError
+
+    def list_metric_descriptors(self, type_prefix):
+        """
+        :param str type_prefix: Only list descriptors whose type starts with
+            this. IE: custom.googleapis.com/
+        :rtype: generator
+        :returns: A generator of MetricDescriptor dicts.
+        """
+        raise NotImplementedError
+
+    def get_metric_descriptor(self, metric_type):
+        """
+        :param str metric_type: The full metric type to look up.
+        :rtype: dict
+        :returns: The MetricDescriptor dict, or None if it doesn't exist.
+        """
+        raise NotImplementedError
+
+    def write_timeseries(self, timeseries_list):
+        """
+        :param list timeseries_list: TimeSeries dicts to write, each with a
+            single point. There may be at most :py:attr:`max_write_batch_size`
+            of these, and no more than one point per time series.
+        """
+        raise NotImplementedError
+
+    def list_timeseries(self, metric_filter, start_time, end_time,
+                        aggregation=None, page_size=100):
+        """
+        :param MetricFilter metric_filter: The time series to match.
+        :param datetime.datetime start_time: Beginning of the interval to
+            query.
+        :param datetime.datetime end_time: End of the interval to query.
+        :param Aggregation aggregation: Optionally, how to aggregate the
+            points.
+        :param int page_size: Max number of results to fetch at a time, for
+            backends that paginate.
+        :rtype: generator
+        :returns: A generator of tuples in the form of: labels, points. The
+            points are Point dicts, newest first. A series may be split
+            across more than one tuple.
+        """
+        raise NotImplementedError
+
+    def get_failed_timeseries_indices(self, exc, timeseries_count):
+        """
+        :param Exception exc: The error that write_timeseries() raised.
+        :param int timeseries_count: How many time series were written.
+        :rtype: list
+        :returns: The indices of the time series that weren't written. By
+            default, we assume none of them were.
+        """
+        return range(timeseries_count)
+
+    def get_duplicate_timeseries_indices(self, exc, timeseries_count):
+        """
+        :param Exception exc: The error that write_timeseries() raised.
+        :param int timeseries_count: How many time series were written.
+        :rtype: list
+        :returns: The indices of the time series that weren't written
+            because the point already exists. By default, we can't tell.
+        """
+        return []
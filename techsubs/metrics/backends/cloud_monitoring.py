@@ -0,0 +1,224 @@
+"""
+Stores metrics in Google Cloud Monitoring (v3).
+"""
+import os
+import re
+import threading
+
+from googleapiclient import discovery
+from googleapiclient.errors import HttpError
+from oauth2client.client import GoogleCredentials
+from google.appengine.api.app_identity import get_application_id
+
+from techsubs.metrics.backends.base import BaseMetricsBackend, one_of
+from techsubs.metrics.common import format_rfc3339
+
+# We ship the Monitoring v3 discovery document with the app, trimmed down to
+# the methods we use, so that building a client doesn't cost a round trip.
+MONITORING_DISCOVERY_DOC_PATH = os.path.join(
+    os.path.dirname(__file__), 'monitoring_v3_discovery.json')
+
+# The httplib2.Http that googleapiclient uses under the hood isn't
+# thread-safe, so each thread gets its own client.
+_client_local = threading.local()
+_discovery_doc = None
+
+# The most time series that timeSeries.create accepts per request.
+TIMESERIES_PER_CREATE_REQUEST = 200
+# Monitoring points at the offending series in its error messages with
+# field paths like: timeSeries[12].points[0]
+TIMESERIES_ERROR_INDEX_RE = re.compile(r'timeSeries\[(\d+)\]')
+# What Monitoring says when we write a point that it already has. It can't
+# tell a re-sent point apart from an out of order one, but either way
+# there's no use retrying.
+DUPLICATE_POINT_ERROR_RE = re.compile(
+    r'already exists|written in order|same end time|older end time',
+    re.IGNORECASE)
+
+
+def get_metrics_client():
+    """
+    Clients are built once per thread, then re-used. Their credentials
+    refresh expired access tokens in place, so they don't go stale.
+
+    :return: A properly discovered and built Google Metrics client.
+    """
+    client = getattr(_client_local, 'client', None)
+    if client is None:
+        credentials = GoogleCredentials.get_application_default()
+        client = discovery.build_from_document(
+            _get_discovery_doc(), credentials=credentials)
+        _client_local.client = client
+    return client
+
+
+def _get_discovery_doc():
+    """
+    :rtype: str
+    :return: The bundled Monitoring v3 discovery document.
+    """
+    global _discovery_doc
+    if _discovery_doc is None:
+        with open(MONITORING_DISCOVERY_DOC_PATH) as discovery_file:
+            _discovery_doc = discovery_file.read()
+    return _discovery_doc
+
+
+def _get_project_resource():
+    """
+    :rtype: str
+    :returns: Our Monitoring project's resource name.
+    """
+    return "projects/{0}".format(get_application_id())
+
+
+def build_filter_str(metric_filter):
+    """
+    :param MetricFilter metric_filter: The time series to match.
+    :rtype: str
+    :returns: A Monitoring filter string.
+    """
+    filter_str = 'metric.type="{}"'.format(metric_filter.metric_type)
+    # Sorted, so that identical filters make identical requests.
+    for label_name, label_val in sorted(metric_filter.labels.items()):
+        if isinstance(label_val, one_of):
+            label_val = 'one_of({})'.format(', '.join(
+                '"{}"'.format(val) for val in sorted(label_val)))
+        else:
+            label_val = '"{}"'.format(label_val)
+        filter_str += ' AND metric.label.{}={}'.format(label_name, label_val)
+    return filter_str
+
+
+def build_aggregation_params(aggregation):
+    """
+    :param Aggregation aggregation: How to aggregate the points, or None.
+    :rtype: dict
+    :returns: Keyword arguments for a timeSeries.list request.
+    """
+    if aggregation is None:
+        return {}
+    params = {
+        'aggregation_alignmentPeriod': '{}s'.format(
+            aggregation.alignment_period),
+        'aggregation_perSeriesAligner': aggregation.per_series_aligner,
+    }
+    if aggregation.cross_series_reducer:
+        params['aggregation_crossSeriesReducer'] = \
+            aggregation.cross_series_reducer
+    if aggregation.group_by_fields:
+        params['aggregation_groupByFields'] = aggregation.group_by_fields
+    return params
+
+
+class CloudMonitoringBackend(BaseMetricsBackend):
+    """
+    Reads and writes metrics through the Monitoring v3 API.
+    """
+    max_write_batch_size = TIMESERIES_PER_CREATE_REQUEST
+
+    def create_metric_descriptor(self, descriptor):
+        if descriptor['metricKind'] == 'DELTA':
+            # Monitoring only takes GAUGE and CUMULATIVE custom metrics.
+            raise ValueError(
+                "Custom DELTA metrics aren't supported: %s" %
+                descriptor['type'])
+        client = get_metrics_client()
+        return client.projects().metricDescriptors().create(
+            name=_get_project_resource(), body=descriptor).execute()
+
+    def list_metric_descriptors(self, type_prefix):
+        client = get_metrics_client()
+        project_resource = _get_project_resource()
+        filter_str = 'metric.type = starts_with("{}")'.format(type_prefix)
+
+        next_page_token = None
+        while True:
+            response = client.projects().metricDescriptors().list(
+                name=project_resource, filter=filter_str,
+                pageToken=next_page_token).execute()
+            next_page_token = response.get('nextPageToken')
+            for descriptor in response.get('metricDescriptors', []):
+                yield descriptor
+
+            if not next_page_token:
+                break
+
+    def get_metric_descriptor(self, metric_type):
+        client = get_metrics_client()
+        md_name = "{}/metricDescriptors/{}".format(
+            _get_project_resource(), metric_type)
+        try:
+            return client.projects().metricDescriptors().get(
+                name=md_name).execute()
+        except HttpError as exc:
+            if exc.resp.status == 404:
+                return None
+            raise
+
+    def write_timeseries(self, timeseries_list):
+        client = get_metrics_client()
+        request = client.projects().timeSeries().create(
+            name=_get_project_resource(), body={"timeSeries": timeseries_list})
+        request.execute()
+
+    def list_timeseries(self, metric_filter, start_time, end_time,
+                        aggregation=None, page_size=100):
+        client = get_metrics_client()
+        project_resource = _get_project_resource()
+        filter_str = build_filter_str(metric_filter)
+        aggregation_params = build_aggregation_params(aggregation)
+
+        next_page_token = None
+        # Automatically paginate through the metric results.
+        while True:
+            request = client.projects().timeSeries().list(
+                name=project_resource,
+                filter=filter_str,
+                pageSize=page_size,
+                interval_startTime=format_rfc3339(start_time),
+                interval_endTime=format_rfc3339(end_time),
+                pageToken=next_page_token,
+                **aggregation_params)
+
+            response = request.execute()
+            next_page_token = response.get('nextPageToken')
+            for timeseries in response.get('timeSeries', []):
+                yield (timeseries['metric'].get('labels', {}),
+                       timeseries['points'])
+
+            if not next_page_token:
+                break
+
+    def get_failed_timeseries_indices(self, exc, timeseries_count):
+        if not isinstance(exc, HttpError):
+            return range(timeseries_count)
+        failed_indices = set()
+        for match in TIMESERIES_ERROR_INDEX_RE.finditer(exc.content or ''):
+            index = int(match.group(1))
+            if index < timeseries_count:
+                failed_indices.add(index)
+        # The series that Monitoring didn't point at were written.
+        return sorted(failed_indices) or range(timeseries_count)
+
+    def get_duplicate_timeseries_indices(self, exc, timeseries_count):
+        if not isinstance(exc, HttpError):
+            return []
+        content = exc.content or ''
+        index_matches = list(TIMESERIES_ERROR_INDEX_RE.finditer(content))
+        if not index_matches:
+            # Nothing to go by but the message as a whole.
+            if timeseries_count == 1 and DUPLICATE_POINT_ERROR_RE.search(
+                    content):
+                return [0]
+            return []
+
+        duplicate_indices = []
+        # Each series' complaint runs until the next one starts.
+        ends = [match.start() for match in index_matches[1:]] + [None]
+        for match, end in zip(index_matches, ends):
+            index = int(match.group(1))
+            if index < timeseries_count and DUPLICATE_POINT_ERROR_RE.search(
+                    content[match.start():end]):
+                duplicate_indices.append(index)
+        return duplicate_indices
@@ -0,0 +1,390 @@
+"""
+Stores metrics in a local SQLite database. This lets us run (and load-test)
+the scanners and populators without a Google project, and gives small
+deployments very fast queries.
+
+.. note:: SQLite isn't available on App Engine's production runtime. Use
+    this with the development server, or anywhere else that we run the app.
+"""
+import json
+import sqlite3
+import calendar
+import datetime
+import threading
+
+from techsubs.metrics.backends.base import BaseMetricsBackend, one_of
+from techsubs.metrics.common import format_rfc3339, parse_rfc3339_epoch
+from techsubs.utils import chunked
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metric_descriptors (
+    type TEXT PRIMARY KEY,
+    descriptor TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS metric_series (
+    series_id INTEGER PRIMARY KEY,
+    metric_type TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    UNIQUE (metric_type, labels)
+);
+CREATE TABLE IF NOT EXISTS metric_points (
+    series_id INTEGER NOT NULL REFERENCES metric_series (series_id),
+    timestamp INTEGER NOT NULL,
+    value_key TEXT NOT NULL,
+    value NUMERIC NOT NULL,
+    PRIMARY KEY (series_id, timestamp)
+);
+"""
+
+# How each per-series aligner is computed within an alignment period.
+ALIGNER_SQL = {
+    'ALIGN_MIN': 'MIN(value)',
+    'ALIGN_MAX': 'MAX(value)',
+    'ALIGN_MEAN': 'AVG(value)',
+    'ALIGN_SUM': 'SUM(value)',
+    'ALIGN_COUNT': 'COUNT(value)',
+}
+# How each cross-series reducer combines the aligned values.
+REDUCERS = {
+    'REDUCE_MIN': min,
+    'REDUCE_MAX': max,
+    'REDUCE_MEAN': lambda values: float(sum(values)) / len(values),
+    'REDUCE_SUM': sum,
+    'REDUCE_COUNT': len,
+}
+# SQLite limits how many parameters a statement may have.
+MAX_SERIES_PER_QUERY = 500
+
+
+class DuplicatePointError(Exception):
+    """
+    Raised when points are written for times that a series already has a
+    point for. Like Monitoring, we don't allow overwriting points.
+    """
+    def __init__(self, message, failed_indices):
+        """
+        :param str message: What went wrong.
+        :param list failed_indices: The indices of the time series that
+            weren't written.
+        """
+        super(DuplicatePointError, self).__init__(message)
+        self.failed_indices = failed_indices
+
+
+class SQLiteBackend(BaseMetricsBackend):
+    """
+    Keeps each time series in metric_series, keyed on its metric type and
+    its labels (as canonical JSON). Points are keyed on their series and
+    end time, in epoch seconds. Distribution values are stored as JSON.
+    """
+    # SQLite is happy with much bigger batches than Monitoring.
+    max_write_batch_size = 1000
+
+    def __init__(self, db_path):
+        """
+        :param str db_path: Path to the SQLite database. Created if it
+            doesn't exist yet.
+        """
+        self.db_path = db_path
+        # sqlite3 connections can't be shared across threads.
+        self._local = threading.local()
+
+    def _get_connection(self):
+        """
+        :rtype: sqlite3.Connection
+        :returns: This thread's database connection.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+        return conn
+
+    def create_metric_descriptor(self, descriptor):
+        conn = self._get_connection()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO metric_descriptors VALUES (?, ?)',
+                (descriptor['type'], json.dumps(descriptor)))
+        return descriptor
+
+    def list_metric_descriptors(self, type_prefix):
+        conn = self._get_connection()
+        rows = conn.execute(
+            'SELECT descriptor FROM metric_descriptors '
+            'WHERE substr(type, 1, ?) = ?', (len(type_prefix), type_prefix))
+        for descriptor_json, in rows:
+            yield json.loads(descriptor_json)
+
+    def get_metric_descriptor(self, metric_type):
+        conn = self._get_connection()
+        row = conn.execute(
+            'SELECT descriptor FROM metric_descriptors WHERE type = ?',
+            (metric_type,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def write_timeseries(self, timeseries_list):
+        conn = self._get_connection()
+        rows = [self._get_point_row(conn, timeseries)
+                for timeseries in timeseries_list]
+        try:
+            with conn:
+                conn.executemany(
+                    'INSERT INTO metric_points VALUES (?, ?, ?, ?)', rows)
+            return
+        except sqlite3.IntegrityError:
+            pass
+
+        # Something in there was a duplicate. Go row by row, so the rest
+        # still get written.
+        failed_indices = []
+        with conn:
+            for index, row in enumerate(rows):
+                try:
+                    conn.execute(
+                        'INSERT INTO metric_points VALUES (?, ?, ?, ?)', row)
+                except sqlite3.IntegrityError:
+                    failed_indices.append(index)
+        raise DuplicatePointError(
+            "Points already exist for timeSeries%s." % failed_indices,
+            failed_indices)
+
+    def get_failed_timeseries_indices(self, exc, timeseries_count):
+        if isinstance(exc, DuplicatePointError):
+            return exc.failed_indices
+        return range(timeseries_count)
+
+    def get_duplicate_timeseries_indices(self, exc, timeseries_count):
+        if isinstance(exc, DuplicatePointError):
+            return exc.failed_indices
+        return []
+
+    def _get_point_row(self, conn, timeseries):
+        """
+        :param sqlite3.Connection conn: The database connection.
+        :param dict timeseries: A TimeSeries dict with one point.
+        :rtype: tuple
+        :returns: A metric_points row for the point.
+        """
+        metric = timeseries['metric']
+        series_id = self._get_series_id(
+            conn, metric['type'], metric.get('labels', {}))
+        point = timeseries['points'][0]
+        (value_key, value), = point['value'].items()
+        if value_key == 'int64Value':
+            value = int(value)
+        elif value_key == 'doubleValue':
+            value = float(value)
+        elif value_key == 'distributionValue':
+            # Kept whole, as JSON. These can't be aligned.
+            value = json.dumps(value, sort_keys=True)
+        else:
+            raise ValueError('Un-implemented value type: %s' % value_key)
+        timestamp = parse_rfc3339_epoch(point['interval']['endTime'])
+        return series_id, timestamp, value_key, value
+
+    def _get_series_id(self, conn, metric_type, labels):
+        """
+        :param sqlite3.Connection conn: The database connection.
+        :param str metric_type: The series' metric type.
+        :param dict labels: The series' labels.
+        :rtype: int
+        :returns: The series' ID, creating it if needed.
+        """
+        labels_json = json.dumps(labels, sort_keys=True)
+        with conn:
+            conn.execute(
+                'INSERT OR IGNORE INTO metric_series (metric_type, labels) '
+                'VALUES (?, ?)', (metric_type, labels_json))
+        return conn.execute(
+            'SELECT series_id FROM metric_series '
+            'WHERE metric_type = ? AND labels = ?',
+            (metric_type, labels_json)).fetchone()[0]
+
+    def list_timeseries(self, metric_filter, start_time, end_time,
+                        aggregation=None, page_size=100):
+        # Like Monitoring, reads cover (start_time, end_time].
+        conn = self._get_connection()
+        series_labels = self._find_series(conn, metric_filter)
+        start_ts = _to_epoch(start_time)
+        end_ts = _to_epoch(end_time)
+
+        if aggregation is None or \
+                aggregation.per_series_aligner == 'ALIGN_NONE':
+            point_rows = self._select_raw_points(
+                conn, series_labels, start_ts, end_ts)
+        else:
+            point_rows = self._select_aligned_points(
+                conn, series_labels, start_ts, end_ts, aggregation)
+
+        if aggregation is not None and aggregation.cross_series_reducer and \
+                aggregation.cross_series_reducer != 'REDUCE_NONE':
+            series_points = _reduce_series(
+                point_rows, series_labels, aggregation)
+        else:
+            series_points = {}
+            for series_id, timestamp, value_key, value in point_rows:
+                series_points.setdefault(
+                    series_id, []).append((timestamp, value_key, value))
+            series_points = [(series_labels[series_id], points)
+                             for series_id, points in series_points.items()]
+
+        for labels, points in series_points:
+            points.sort(reverse=True)
+            yield labels, [_make_point(timestamp, value_key, value)
+                           for timestamp, value_key, value in points]
+
+    def _find_series(self, conn, metric_filter):
+        """
+        :param sqlite3.Connection conn: The database connection.
+        :param MetricFilter metric_filter: The time series to match.
+        :rtype: dict
+        :returns: A dict of matching series IDs to their labels.
+        """
+        series_labels = {}
+        rows = conn.execute(
+            'SELECT series_id, labels FROM metric_series '
+            'WHERE metric_type = ?', (metric_filter.metric_type,))
+        for series_id, labels_json in rows:
+            labels = json.loads(labels_json)
+            if _labels_match(labels, metric_filter.labels):
+                series_labels[series_id] = labels
+        return series_labels
+
+    def _select_raw_points(self, conn, series_labels, start_ts, end_ts):
+        """
+        :param sqlite3.Connection conn: The database connection.
+        :param dict series_labels: The series to select points for.
+        :param int start_ts: Beginning of the interval, in epoch seconds.
+        :param int end_ts: End of the interval, in epoch seconds.
+        :rtype: generator
+        :returns: A generator of (series_id, timestamp, value_key, value)
+            tuples.
+        """
+        for series_ids in chunked(list(series_labels), MAX_SERIES_PER_QUERY):
+            query = (
+                'SELECT series_id, timestamp, value_key, value '
+                'FROM metric_points WHERE series_id IN ({}) '
+                'AND timestamp > ? AND timestamp <= ?'.format(
+                    ', '.join('?' * len(series_ids))))
+            for row in conn.execute(query, series_ids + [start_ts, end_ts]):
+                yield row
+
+    def _select_aligned_points(self, conn, series_labels, start_ts, end_ts,
+                               aggregation):
+        """
+        Like Monitoring, alignment periods are counted back from the end of
+        the interval, and each aligned point is stamped with its period's
+        end time. Each period includes its end time, but not its start.
+
+        :param sqlite3.Connection conn: The database connection.
+        :param dict series_labels: The series to select points for.
+        :param int start_ts: Beginning of the interval, in epoch seconds.
+        :param int end_ts: End of the interval, in epoch seconds.
+        :param Aggregation aggregation: How to align the points.
+        :rtype: generator
+        :returns: A generator of (series_id, timestamp, value_key, value)
+            tuples.
+        """
+        aligner = aggregation.per_series_aligner
+        if aligner not in ALIGNER_SQL:
+            raise ValueError('Un-implemented aligner: %s' % aligner)
+        period = aggregation.alignment_period
+        for series_ids in chunked(list(series_labels), MAX_SERIES_PER_QUERY):
+            query = (
+                'SELECT series_id, (? - timestamp) / ? AS bucket, '
+                'MAX(value_key), {} FROM metric_points '
+                'WHERE series_id IN ({}) AND timestamp > ? AND timestamp <= ? '
+                'GROUP BY series_id, bucket'.format(
+                    ALIGNER_SQL[aligner], ', '.join('?' * len(series_ids))))
+            params = [end_ts, period] + series_ids + [start_ts, end_ts]
+            for series_id, bucket, value_key, value in conn.execute(
+                    query, params):
+                if value_key == 'distributionValue':
+                    raise ValueError("Distributions can't be aligned.")
+                if aligner == 'ALIGN_MEAN':
+                    value_key = 'doubleValue'
+                elif aligner == 'ALIGN_COUNT':
+                    value_key = 'int64Value'
+                yield series_id, end_ts - bucket * period, value_key, value
+
+
+def _reduce_series(point_rows, series_labels, aggregation):
+    """
+    Combines aligned points across series.
+
+    :param generator point_rows: (series_id, timestamp, value_key, value)
+        tuples.
+    :param dict series_labels: A dict of series IDs to their labels.
+    :param Aggregation aggregation: How to reduce the series.
+    :rtype: list
+    :returns: A list of (labels, points) tuples, where points are
+        (timestamp, value_key, value) tuples.
+    """
+    reducer = aggregation.cross_series_reducer
+    if reducer not in REDUCERS:
+        raise ValueError('Un-implemented reducer: %s' % reducer)
+    group_labels = [field.split('.')[-1]
+                    for field in aggregation.group_by_fields or []]
+
+    grouped_values = {}
+    for series_id, timestamp, value_key, value in point_rows:
+        labels = series_labels[series_id]
+        group_key = tuple(labels.get(label) for label in group_labels)
+        grouped_values.setdefault(group_key, {}).setdefault(
+            timestamp, (value_key, []))[1].append(value)
+
+    reduced_series = []
+    for group_key, values_by_time in grouped_values.items():
+        labels = dict(zip(group_labels, group_key))
+        points = []
+        for timestamp, (value_key, values) in values_by_time.items():
+            if reducer == 'REDUCE_MEAN':
+                value_key = 'doubleValue'
+            elif reducer == 'REDUCE_COUNT':
+                value_key = 'int64Value'
+            points.append((timestamp, value_key, REDUCERS[reducer](values)))
+        reduced_series.append((labels, points))
+    return reduced_series
+
+
+def _labels_match(labels, label_filters):
+    """
+    :param dict labels: A series' labels.
+    :param dict label_filters: Label keys to a value or a one_of set.
+    :rtype: bool
+    """
+    for label_name, label_val in label_filters.items():
+        if isinstance(label_val, one_of):
+            if labels.get(label_name) not in label_val:
+                return False
+        elif labels.get(label_name) != label_val:
+            return False
+    return True
+
+
+def _make_point(timestamp, value_key, value):
+    """
+    :param int timestamp: The point's time, in epoch seconds.
+    :param str value_key: The TypedValue key. IE: int64Value.
+    :param value: The point's value.
+    :rtype: dict
+    :returns: A Monitoring-style Point dict.
+    """
+    time_str = format_rfc3339(datetime.datetime.utcfromtimestamp(timestamp))
+    if value_key == 'distributionValue':
+        value = json.loads(value)
+    return {
+        'interval': {'startTime': time_str, 'endTime': time_str},
+        'value': {value_key: value},
+    }
+
+
+def _to_epoch(dt):
+    """
+    :param datetime.datetime dt: A naive UTC datetime.
+    :rtype: int
+    :returns: Seconds since the epoch.
+    """
+    return calendar.timegm(dt.utctimetuple())
@@ -1,18 +1,397 @@
+import json
+import array
+import hashlib
+import logging
+import calendar
 import datetime
+import threading
+from collections import namedtuple
 
-from googleapiclient import discovery
-from oauth2client.client import GoogleCredentials
+from google.appengine.api import memcache
 from google.appengine.api.app_identity import get_application_id
 
 from techsubs import app
+from techsubs.exceptions import MetricWriteError
+from techsubs.metrics.backends import get_metrics_backend
+from techsubs.metrics.backends.base import MetricFilter, Aggregation
+from techsubs.metrics.distribution import Distribution
+from techsubs.metrics.ledger import get_point_id, get_timeseries_point_id, \
+    are_points_recorded, record_points
+from techsubs.metrics.recent_history import update_recent_history, \
+    SECONDS_PER_HOUR
 
+try:
+    import numpy
+except ImportError:
+    # Columnar query results fall back to plain arrays.
+    numpy = None
 
-def get_metrics_client():
+# Tracks the MetricBatches that are open on this thread. The innermost one
+# collects any points that get written.
+_batch_local = threading.local()
+
+# Array typecodes for columnar query results. Epoch seconds fit in a long.
+# Python 2's array module has no 'q', but 'l' is 64-bit on our hosts.
+TIMESTAMP_TYPECODE = 'l'
+try:
+    array.array('q')
+    INT64_TYPECODE = 'q'
+except ValueError:
+    INT64_TYPECODE = 'l'
+DOUBLE_TYPECODE = 'd'
+
+# RFC 3339 dates are all the same length, and most of a query's timestamps
+# fall on the same handful of days. Cache each day's midnight epoch time.
+_epoch_day_cache = {}
+
+# Every metric type we define starts with this.
+CUSTOM_METRIC_TYPE_PREFIX = 'custom.googleapis.com/'
+# Memcache key prefix for the descriptors that are known to be up to date.
+# Keyed on metric type, with the descriptor's fingerprint as the value, so
+# that a changed definition gets checked again.
+DESCRIPTOR_CACHE_KEY_PREFIX = 'metric-descriptor:'
+# The metric classes whose descriptors this instance has made sure of.
+_synced_metrics = set()
+
+# A time series that a MetricBatch failed to write. metric is the
+# BaseMetric sub-class, timeseries is the TimeSeries dict that was sent,
+# and error is the exception the backend raised.
+TimeSeriesWriteFailure = namedtuple(
+    'TimeSeriesWriteFailure', ['metric', 'timeseries', 'error'])
+
+
+def send_timeseries(timeseries_list):
+    """
+    Writes time series to the metrics backend in a single request.
+
+    :param list timeseries_list: TimeSeries dicts to write. There may be at
+        most the backend's ``max_write_batch_size`` of these, and no more
+        than one point per time series.
+    """
+    get_metrics_backend().write_timeseries(timeseries_list)
+
+
+def get_current_metric_batch():
+    """
+    :rtype: MetricBatch
+    :returns: The innermost MetricBatch that is open on this thread, or
+        None if points are being sent right away.
+    """
+    batches = getattr(_batch_local, 'batches', None)
+    return batches[-1] if batches else None
+
+
+class MetricBatch(object):
+    """
+    Collects metric points and sends them in as few backend writes (for
+    Monitoring, timeSeries.create calls) as possible. While one of these is
+    open as a context manager, any ``write_gauge()`` on this thread is added
+    to it instead of being sent right away. Points are flushed whenever a
+    full request's worth builds up, and when the block exits::
+
+        with MetricBatch() as metric_batch:
+            SubRedditSubscribers.write_gauge(...)
+            SubRedditAccountsActive.write_gauge(...)
+        metric_batch.raise_for_errors()
+
+    Failed writes don't raise on their own. They are collected in
+    :py:attr:`errors` so the caller can decide what a partial failure means.
+
+    Writes are idempotent. Points that the point ledger says were already
+    accepted are skipped, and the backend telling us that a point already
+    exists counts as success. See :py:mod:`techsubs.metrics.ledger`.
+    """
+    def __init__(self, max_request_size=None):
+        """
+        :param int max_request_size: The most time series to send per
+            write. Defaults to the most the backend accepts.
+        """
+        self.max_request_size = max_request_size or \
+            get_metrics_backend().max_write_batch_size
+        # A list of (metric, timeseries) tuples waiting to be sent.
+        self.pending = []
+        # A list of TimeSeriesWriteFailure tuples.
+        self.errors = []
+        # How many time series have been sent successfully.
+        self.sent_count = 0
+        # How many time series were skipped, since they were already sent.
+        self.skipped_count = 0
+
+    def __enter__(self):
+        if not hasattr(_batch_local, 'batches'):
+            _batch_local.batches = []
+        _batch_local.batches.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _batch_local.batches.remove(self)
+        # Whatever made it in before an exception is still good data, and
+        # would have been sent already without the batch.
+        self.flush()
+        return False
+
+    def add(self, metric, timeseries):
+        """
+        :param BaseMetric metric: The metric class the point is for.
+        :param dict timeseries: A TimeSeries dict with one point.
+        """
+        self.pending.append((metric, timeseries))
+        if len(self.pending) >= self.max_request_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Sends everything that's pending.
+
+        :rtype: list
+        :returns: The TimeSeriesWriteFailure tuples from this flush.
+        """
+        pending, self.pending = self.pending, []
+        failures = []
+        if not pending:
+            return failures
+
+        already_recorded = are_points_recorded(
+            [get_timeseries_point_id(timeseries) for _, timeseries in pending])
+        self.skipped_count += sum(already_recorded)
+        pending = [entry for entry, is_recorded
+                   in zip(pending, already_recorded) if not is_recorded]
+        for chunk in self._chunk_pending(pending):
+            failures.extend(self._send_chunk(chunk))
+        self.errors.extend(failures)
+
+        failed_ids = set(id(failure.timeseries) for failure in failures)
+        self._update_recent_history(
+            [entry for entry in pending if id(entry[1]) not in failed_ids])
+        return failures
+
+    def raise_for_errors(self):
+        """
+        :raises: MetricWriteError if any time series failed to write.
+        """
+        if self.errors:
+            raise MetricWriteError(
+                "Failed to write %d of %d time series." % (
+                    len(self.errors), len(self.errors) + self.sent_count),
+                failures=list(self.errors))
+
+    def _chunk_pending(self, pending):
+        """
+        Splits points up into request-sized chunks. Monitoring only accepts
+        one point per time series per request, so a series that shows up
+        again starts a new chunk.
+
+        :param list pending: (metric, timeseries) tuples to chunk.
+        :rtype: generator
+        :returns: A generator of lists of (metric, timeseries) tuples.
+        """
+        chunk = []
+        chunk_series = set()
+        for metric, timeseries in pending:
+            series_key = _get_timeseries_key(timeseries)
+            if len(chunk) >= self.max_request_size or \
+                    series_key in chunk_series:
+                yield chunk
+                chunk = []
+                chunk_series = set()
+            chunk.append((metric, timeseries))
+            chunk_series.add(series_key)
+        if chunk:
+            yield chunk
+
+    def _update_recent_history(self, accepted):
+        """
+        Copies accepted points into the recent history store, for the
+        metrics that track it.
+
+        :param list accepted: (metric, timeseries) tuples that were written.
+        """
+        history_points = {}
+        for metric, timeseries in accepted:
+            if not metric.track_recent_history:
+                continue
+            labels = timeseries['metric']['labels']
+            point = timeseries['points'][0]
+            hour = parse_rfc3339_epoch(
+                point['interval']['endTime']) // SECONDS_PER_HOUR
+            value = point['value'][metric._value_type_to_typed_value()]
+            history_points.setdefault(labels['environment'], []).append(
+                (metric, labels['subreddit'], hour, int(value)))
+        for environment, points in history_points.items():
+            update_recent_history(points, environment)
+
+    def _send_chunk(self, chunk):
+        """
+        :param list chunk: (metric, timeseries) tuples to send in one call.
+        :rtype: list
+        :returns: A list of TimeSeriesWriteFailure tuples.
+        """
+        failed_indices = []
+        error = None
+        try:
+            send_timeseries([timeseries for _, timeseries in chunk])
+        except Exception as exc:
+            backend = get_metrics_backend()
+            error = exc
+            # Some backends can tell us which series were the problem. The
+            # ones that already had the point were written, as far as we
+            # care.
+            duplicate_indices = set(
+                backend.get_duplicate_timeseries_indices(exc, len(chunk)))
+            failed_indices = [
+                i for i in backend.get_failed_timeseries_indices(
+                    exc, len(chunk))
+                if i not in duplicate_indices]
+            if failed_indices:
+                logging.exception("Failed to write time series.")
+
+        failed_index_set = set(failed_indices)
+        record_points([get_timeseries_point_id(timeseries)
+                       for i, (_, timeseries) in enumerate(chunk)
+                       if i not in failed_index_set])
+        self.sent_count += len(chunk) - len(failed_indices)
+        return [TimeSeriesWriteFailure(chunk[i][0], chunk[i][1], error)
+                for i in failed_indices]
+
+
+def _get_timeseries_key(timeseries):
+    """
+    :param dict timeseries: A TimeSeries dict.
+    :rtype: tuple
+    :returns: A hashable value that identifies the time series.
+    """
+    metric = timeseries['metric']
+    return metric['type'], tuple(sorted(metric['labels'].items()))
+
+
+def get_environment():
+    """
+    :rtype: str
+    :returns: The environment label that this instance's points are
+        written with. One of 'prod' or 'dev'.
+    """
+    return 'prod' if app.config['IS_PRODUCTION'] else 'dev'
+
+
+def build_metric_filter(metric_type, environment, metric_label_filters=None):
+    """
+    :param str metric_type: The metric type to query.
+    :param str environment: One of 'prod' or 'dev'.
+    :param dict metric_label_filters: Optionally, only match metrics with
+        these label key/vals. Values may be
+        :py:class:`techsubs.metrics.backends.base.one_of` sets.
+    :rtype: MetricFilter
+    :returns: A filter spec that any metrics backend can apply.
+    """
+    labels = dict(metric_label_filters or {})
+    labels['environment'] = environment
+    return MetricFilter(metric_type, labels)
+
+
+def build_aggregation(alignment_period, per_series_aligner,
+                      cross_series_reducer=None, group_by_fields=None):
+    """
+    Has the metrics backend aggregate points for us, so we only pull back
+    what we need. For example, the peak of each series over the past day::
+
+        build_aggregation(datetime.timedelta(days=1), 'ALIGN_MAX')
+
+    .. note:: ALIGN_DELTA and ALIGN_RATE only work on CUMULATIVE and DELTA
+        metrics. Monitoring rejects them for gauges.
+
+    :param datetime.timedelta alignment_period: How much time each aligned
+        point covers.
+    :param str per_series_aligner: How to combine each series' points within
+        an alignment period. IE: ALIGN_MAX, ALIGN_SUM, ALIGN_MEAN.
+    :param str cross_series_reducer: Optionally, how to combine the aligned
+        series with each other. IE: REDUCE_SUM.
+    :param list group_by_fields: When reducing across series, the fields to
+        keep series separate by. IE: ['metric.label.subreddit'].
+    :rtype: Aggregation
+    :returns: An aggregation spec that any metrics backend can apply.
+    """
+    return Aggregation(
+        int(alignment_period.total_seconds()), per_series_aligner,
+        cross_series_reducer, group_by_fields)
+
+
+def _iter_single_series_points(timeseries_iter):
     """
-    :return: A properly discovered and built Google Metrics client.
+    :param generator timeseries_iter: A generator of (labels, points)
+        tuples from a query that should only match one time series.
+    :rtype: generator
+    :returns: A generator of lists of raw Point dicts.
+    :raises: AssertionError if more than one time series comes back.
     """
-    credentials = GoogleCredentials.get_application_default()
-    return discovery.build('monitoring', 'v3', credentials=credentials)
+    series_labels = None
+    for labels, points in timeseries_iter:
+        # A long series may be split up across pages.
+        assert series_labels in (None, labels), \
+            "Metrics query returned more than 1 time series. Check your " \
+            "filters."
+        series_labels = labels
+        yield points
+
+
+class PointColumns(object):
+    """
+    Builds up a time series' points as two parallel columns: epoch-second
+    timestamps, and values. These take a fraction of the memory of a dict
+    per point, and skip the datetime parsing. The points are kept in the
+    order the backend returns them, which is newest first.
+
+    The columns come back as NumPy arrays if NumPy is available, otherwise
+    as :py:mod:`array` arrays. Either can be indexed, iterated, and len()'d.
+    """
+    def __init__(self):
+        self.times = array.array(TIMESTAMP_TYPECODE)
+        # Created once we see what type of values we're getting.
+        self.values = None
+
+    def extend(self, points, typed_value_key):
+        """
+        :param list points: Raw Point dicts from a timeSeries.list response.
+        :param str typed_value_key: The TypedValue key the metric's values
+            are sent in. IE: int64Value.
+        """
+        if not points:
+            return
+        if typed_value_key == 'distributionValue':
+            raise ValueError("Distributions can't be put in columns.")
+        if self.values is None:
+            if typed_value_key == 'int64Value' and \
+                    typed_value_key in points[0]['value']:
+                typecode = INT64_TYPECODE
+            else:
+                # DOUBLE metrics, and some aligners (ALIGN_MEAN, for one),
+                # come back as doubles.
+                typecode, typed_value_key = DOUBLE_TYPECODE, 'doubleValue'
+            self.values = array.array(typecode)
+        elif self.values.typecode == DOUBLE_TYPECODE:
+            typed_value_key = 'doubleValue'
+
+        cast = float if self.values.typecode == DOUBLE_TYPECODE else int
+        times_append = self.times.append
+        values_append = self.values.append
+        for point in points:
+            interval = point['interval']
+            # Aligned gauge points may only have an end time.
+            times_append(parse_rfc3339_epoch(
+                interval.get('startTime') or interval['endTime']))
+            values_append(cast(point['value'][typed_value_key]))
+
+    def get_columns(self):
+        """
+        :rtype: tuple
+        :returns: Tuple in the form of: times, values.
+        """
+        values = self.values
+        if values is None:
+            values = array.array(INT64_TYPECODE)
+        if numpy is None:
+            return self.times, values
+        return (numpy.frombuffer(self.times, dtype=self.times.typecode),
+                numpy.frombuffer(values, dtype=values.typecode))
 
 
 def format_rfc3339(datetime_instance=None):
@@ -34,11 +413,169 @@ def get_now_rfc3339():
 
 def parse_rfc3339(dt_str):
     """
-    :param str dt_str: A properly formed RFC 3339 datetime string.
+    :param str dt_str: A properly formed RFC 3339 datetime string. The
+        fractional seconds are optional.
     :rtype: datetime.datetime
-    :return: The corresponding native Python datetime.datetime instance.
+    :return: The corresponding native Python datetime.datetime instance,
+        in UTC.
+    """
+    epoch_seconds, microseconds = _parse_rfc3339_parts(dt_str)
+    return datetime.datetime.utcfromtimestamp(epoch_seconds).replace(
+        microsecond=microseconds)
+
+
+def parse_rfc3339_epoch(dt_str):
+    """
+    A faster :py:func:`parse_rfc3339` for when whole seconds will do.
+
+    :param str dt_str: A properly formed RFC 3339 datetime string. The
+        fractional seconds are optional.
+    :rtype: int
+    :return: Seconds since the epoch. Fractional seconds are dropped.
+    """
+    return _parse_rfc3339_parts(dt_str)[0]
+
+
+def _parse_rfc3339_parts(dt_str):
+    """
+    Parses the fixed-format RFC 3339 timestamps that Monitoring sends,
+    without going through strptime. IE: 2016-07-04T15:00:00Z or
+    2016-07-04T15:00:00.123456789Z.
+
+    :param str dt_str: A properly formed RFC 3339 datetime string.
+    :rtype: tuple
+    :return: Tuple in the form of: epoch_seconds, microseconds.
+    """
+    day_str = dt_str[:10]
+    day_epoch = _epoch_day_cache.get(day_str)
+    if day_epoch is None:
+        day_epoch = calendar.timegm(
+            (int(day_str[:4]), int(day_str[5:7]), int(day_str[8:10]),
+             0, 0, 0))
+        _epoch_day_cache[day_str] = day_epoch
+    epoch_seconds = (day_epoch + int(dt_str[11:13]) * 3600 +
+                     int(dt_str[14:16]) * 60 + int(dt_str[17:19]))
+
+    microseconds = 0
+    zone_start = 19
+    if dt_str[19:20] == '.':
+        zone_start = 20
+        while dt_str[zone_start:zone_start + 1].isdigit():
+            zone_start += 1
+        # Monitoring sometimes sends nanoseconds.
+        microseconds = int(dt_str[20:zone_start][:6].ljust(6, '0'))
+
+    zone = dt_str[zone_start:]
+    if zone not in ('Z', 'z'):
+        offset = int(zone[1:3]) * 3600 + int(zone[4:6]) * 60
+        epoch_seconds += -offset if zone[0] == '+' else offset
+    return epoch_seconds, microseconds
+
+
+def get_all_metrics():
+    """
+    Finds every metric, however deep in the class hierarchy it's defined.
+    Classes without a metric_name (IE: :py:class:`GaugeMetric`) are only
+    there to be sub-classed, and are skipped.
+
+    .. note:: Only metrics whose modules have been imported can be found.
+
+    :rtype: list
+    :returns: The metric classes.
+    """
+    metrics = []
+    seen = set()
+    to_visit = BaseMetric.__subclasses__()
+    while to_visit:
+        metric = to_visit.pop(0)
+        if metric in seen:
+            continue
+        seen.add(metric)
+        to_visit.extend(metric.__subclasses__())
+        if metric.metric_name:
+            metrics.append(metric)
+    return metrics
+
+
+def get_descriptor_fingerprint(descriptor):
+    """
+    :param dict descriptor: A MetricDescriptor dict, either one of ours, or
+        one that the metrics backend returned.
+    :rtype: str
+    :returns: A hash of the parts of the descriptor that we define. The
+        backend fills in defaults and extra fields, which are ignored.
     """
-    return datetime.datetime.strptime(dt_str, "%Y-%m-%dT%H:%M:%S.%fZ")
+    labels = sorted(
+        [label['key'], label.get('valueType', 'STRING'),
+         label.get('description', '')]
+        for label in descriptor.get('labels', []))
+    fingerprint_json = json.dumps([
+        descriptor['type'], descriptor['metricKind'],
+        descriptor['valueType'], descriptor.get('unit', ''),
+        descriptor.get('displayName', ''), descriptor.get('description', ''),
+        labels])
+    return hashlib.sha1(fingerprint_json.encode('utf-8')).hexdigest()
+
+
+def diff_metric_descriptors(metrics, existing_descriptors):
+    """
+    :param list metrics: The metric classes to check.
+    :param iterable existing_descriptors: The MetricDescriptor dicts that
+        the metrics backend already has.
+    :rtype: list
+    :returns: The metrics whose descriptors are missing or differ from
+        their definitions.
+    """
+    existing_fingerprints = {
+        descriptor['type']: get_descriptor_fingerprint(descriptor)
+        for descriptor in existing_descriptors}
+    changed_metrics = []
+    for metric in metrics:
+        descriptor = metric.build_metric_descriptor()
+        if existing_fingerprints.get(descriptor['type']) != \
+                get_descriptor_fingerprint(descriptor):
+            changed_metrics.append(metric)
+    return changed_metrics
+
+
+def sync_metric_descriptors(metrics=None):
+    """
+    Makes sure every metric's descriptor exists and matches its definition.
+    The existing descriptors are listed in one (paginated) call, and only
+    the missing or changed ones are created. This is cheap enough to run on
+    every deploy or instance warmup.
+
+    :param list metrics: The metric classes to sync. Defaults to every
+        metric that :py:func:`get_all_metrics` can find.
+    :rtype: list
+    :returns: The metrics whose descriptors were created or updated.
+    """
+    if metrics is None:
+        metrics = get_all_metrics()
+    existing_descriptors = get_metrics_backend().list_metric_descriptors(
+        CUSTOM_METRIC_TYPE_PREFIX)
+    changed_metrics = diff_metric_descriptors(metrics, existing_descriptors)
+    for metric in changed_metrics:
+        logging.info("Creating or updating metric: %s", metric.metric_name)
+        metric.create_metric()
+    _remember_synced_metrics([
+        (metric, get_descriptor_fingerprint(metric.build_metric_descriptor()))
+        for metric in metrics if metric not in changed_metrics])
+    return changed_metrics
+
+
+def _remember_synced_metrics(metric_fingerprints):
+    """
+    :param list metric_fingerprints: (metric, fingerprint) tuples for the
+        metrics whose descriptors are known to be up to date.
+    """
+    if not metric_fingerprints:
+        return
+    _synced_metrics.update(metric for metric, _ in metric_fingerprints)
+    memcache.set_multi(
+        {CUSTOM_METRIC_TYPE_PREFIX + metric.metric_name: fingerprint
+         for metric, fingerprint in metric_fingerprints},
+        key_prefix=DESCRIPTOR_CACHE_KEY_PREFIX)
 
 
 class BaseMetric(object):
@@ -56,6 +593,9 @@ class BaseMetric(object):
     metric_name = None
     display_name = None
     description = None
+    # For DISTRIBUTION metrics, a BucketOptions dict. See
+    # techsubs.metrics.distribution.
+    bucket_options = None
 
     # Included in all metrics.
     _standard_label_definitions = [
@@ -68,6 +608,11 @@ class BaseMetric(object):
     # Override and add any extras.
     extra_labels = []
 
+    # Set this to copy the metric's points into the recent history store as
+    # they're written. Only for INT64 metrics with a 'subreddit' label, that
+    # are reported hourly. See techsubs.metrics.recent_history.
+    track_recent_history = False
+
     @classmethod
     def _value_type_to_typed_value(cls):
         """
@@ -76,6 +621,10 @@ class BaseMetric(object):
         value_type = cls.metric_value_type
         if value_type == 'INT64':
             return 'int64Value'
+        elif value_type == 'DOUBLE':
+            return 'doubleValue'
+        elif value_type == 'DISTRIBUTION':
+            return 'distributionValue'
         else:
             raise ValueError('Un-implemented value type: %s' % value_type)
 
@@ -90,36 +639,51 @@ class BaseMetric(object):
         value_type = cls.metric_value_type
         if value_type == 'INT64':
             return int(value)
+        elif value_type == 'DOUBLE':
+            return float(value)
+        elif value_type == 'DISTRIBUTION':
+            if isinstance(value, Distribution):
+                return value.to_dict()
+            return dict(value)
         else:
             raise ValueError('Un-implemented value type: %s' % value_type)
 
+    @classmethod
+    def create_distribution(cls):
+        """
+        :rtype: Distribution
+        :returns: An empty distribution using the metric's buckets, to add
+            samples to and then send.
+        """
+        return Distribution(cls.bucket_options)
+
     @classmethod
     def _get_standard_label_values(cls):
         """
         These get automatically reported for any metric we send.
         """
         return {
-            "environment": 'prod' if app.config['IS_PRODUCTION'] else 'dev'
+            "environment": get_environment()
         }
 
     @classmethod
     def _get_metric_vars(cls):
         project_id = get_application_id()
-        md_type = "custom.googleapis.com/{}".format(cls.metric_name)
+        md_type = CUSTOM_METRIC_TYPE_PREFIX + cls.metric_name
         md_name = "projects/{}/metricDescriptors/{}".format(
             project_id, md_type)
         project_resource = "projects/{0}".format(project_id)
         return md_name, md_type, project_resource
 
     @classmethod
-    def create_metric(cls):
+    def build_metric_descriptor(cls):
         """
-        Sets the metric up in Google Metrics. You must do this before
-        sending values in most cases.
+        :rtype: dict
+        :returns: The MetricDescriptor dict that defines this metric.
         """
         labels = cls._standard_label_definitions + cls.extra_labels
         md_name, md_type, project_resource = cls._get_metric_vars()
-        metrics_descriptor = {
+        return {
             "name": md_name,
             "type": md_type,
             "labels": labels,
@@ -130,19 +694,117 @@ class BaseMetric(object):
             "description": cls.description,
         }
 
-        client = get_metrics_client()
-        return client.projects().metricDescriptors().create(
-            name=project_resource, body=metrics_descriptor).execute()
+    @classmethod
+    def create_metric(cls):
+        """
+        Sets the metric up in Google Metrics. If it's already there, its
+        definition gets updated. Use :py:func:`sync_metric_descriptors` or
+        :py:meth:`ensure_descriptor` rather than calling this directly.
+        """
+        metrics_descriptor = cls.build_metric_descriptor()
+        created = get_metrics_backend().create_metric_descriptor(
+            metrics_descriptor)
+        _remember_synced_metrics(
+            [(cls, get_descriptor_fingerprint(metrics_descriptor))])
+        return created
+
+    @classmethod
+    def ensure_descriptor(cls):
+        """
+        Lazily makes sure that the metric's descriptor exists and is up to
+        date, creating or updating it if needed. The answer is cached on
+        the instance and in memcache, so after the first call this costs
+        next to nothing. Every write calls this.
+        """
+        if cls in _synced_metrics:
+            return
+        descriptor = cls.build_metric_descriptor()
+        fingerprint = get_descriptor_fingerprint(descriptor)
+        md_type = descriptor['type']
+        cached_fingerprint = memcache.get(
+            DESCRIPTOR_CACHE_KEY_PREFIX + md_type)
+        if cached_fingerprint != fingerprint:
+            existing = get_metrics_backend().get_metric_descriptor(md_type)
+            if existing is None or \
+                    get_descriptor_fingerprint(existing) != fingerprint:
+                cls.create_metric()
+                return
+        _remember_synced_metrics([(cls, fingerprint)])
+
+    @classmethod
+    def _validate_labels(cls, labels):
+        """
+        Make sure the label values that were passed in are valid.
+
+        :param dict labels: A dict of labels to validate.
+        :raises: ValueError if something is wrong with the labels that
+            were passed in.
+        """
+        labels = labels or {}
+        # The labels that were passed in via `labels`.
+        passed_label_keys = set(labels.keys())
+        # These are the metrics that our definition said we are providing.
+        defined_label_keys = set([l['key'] for l in cls.extra_labels])
+        # If all required labels were specified, this should be empty.
+        diff = defined_label_keys - passed_label_keys
+        if diff:
+            raise ValueError("Missing label value(s): %s" % diff)
 
     @classmethod
     def _write_value(cls, value, interval, labels=None):
         """
-        Used by sub-classes to send metrics to Google Metrics.
+        Used by sub-classes to send metrics to Google Metrics. If a
+        :py:class:`MetricBatch` is open, the point is added to it instead.
+        Otherwise, it's sent through a batch of its own, so that it gets the
+        same duplicate handling.
+
+        :param value: The value to report for the interval.
+        :param tuple interval: A tuple comprised of datetimes for the
+            interval start and end time.
+        :param dict labels: Optionally, apply labels to the point.
+        :raises: MetricWriteError if the point couldn't be written. Only
+            when it isn't going into an open batch.
+        """
+        cls.ensure_descriptor()
+        timeseries_data = cls._build_timeseries(value, interval, labels)
+        metric_batch = get_current_metric_batch()
+        if metric_batch is not None:
+            metric_batch.add(cls, timeseries_data)
+            return
+        with MetricBatch() as metric_batch:
+            metric_batch.add(cls, timeseries_data)
+        metric_batch.raise_for_errors()
+
+    @classmethod
+    def are_points_written(cls, labels_list, point_time):
+        """
+        Checks the point ledger for points that have already been written.
+        Use this to skip work whose results were already sent.
+
+        :param list labels_list: A dict of labels for each point to check.
+        :param datetime.datetime point_time: The time the points were
+            written for.
+        :rtype: list
+        :returns: A list of bools, True for each point that was written.
+        """
+        md_name, md_type, project_resource = cls._get_metric_vars()
+        end_time = format_rfc3339(point_time)
+        point_ids = []
+        for labels in labels_list:
+            all_labels = cls._get_standard_label_values()
+            all_labels.update(labels)
+            point_ids.append(get_point_id(md_type, all_labels, end_time))
+        return are_points_recorded(point_ids)
 
+    @classmethod
+    def _build_timeseries(cls, value, interval, labels=None):
+        """
         :param value: The value to report for the interval.
         :param tuple interval: A tuple comprised of datetimes for the
             interval start and end time.
         :param dict labels: Optionally, apply labels to the point.
+        :rtype: dict
+        :returns: A TimeSeries dict with a single point.
         """
         # We have a standard set of labels that we apply to all metrics.
         all_labels = cls._get_standard_label_values()
@@ -168,16 +830,13 @@ class BaseMetric(object):
                         "endTime": interval[1]
                     },
                     "value": {
-                        cls._value_type_to_typed_value(): value,
+                        cls._value_type_to_typed_value():
+                            cls._cast_value_according_to_type(value),
                     }
                 }
             ]
         }
-
-        client = get_metrics_client()
-        request = client.projects().timeSeries().create(
-            name=project_resource, body={"timeSeries": [timeseries_data]})
-        request.execute()
+        return timeseries_data
 
 
 class GaugeMetric(BaseMetric):
@@ -186,25 +845,6 @@ class GaugeMetric(BaseMetric):
     """
     metric_kind = 'GAUGE'
 
-    @classmethod
-    def _validate_labels(cls, labels):
-        """
-        Make sure the label values that were passed in are valid.
-
-        :param dict labels: A dict of labels to validate.
-        :raises: ValueError if something is wrong with the labels that
-            were passed in.
-        """
-        labels = labels or {}
-        # The metrics that were passed into write_gauge via `labels`.
-        passed_label_keys = set(labels.keys())
-        # These are the metrics that our definition said we are providing.
-        defined_label_keys = set([l['key'] for l in cls.extra_labels])
-        # If all required labels were specified, this should be empty.
-        diff = defined_label_keys - passed_label_keys
-        if diff:
-            raise ValueError("Missing label value(s): %s" % diff)
-
     @classmethod
     def write_gauge(cls, value, labels=None, time_override=None):
         """
@@ -225,57 +865,262 @@ class GaugeMetric(BaseMetric):
 
     @classmethod
     def query_gauge(cls, start_time, end_time, environment='prod',
-                    metric_label_filters=None, page_size=100):
+                    metric_label_filters=None, page_size=100,
+                    aggregation=None):
         """
         Used for returning point values between a start and end time for
         the gauge.
 
-        :param datetime.datetime start_time: Beginning of the interval to query.
+        :param datetime.datetime start_time: Beginning of the interval to
+            query.
         :param datetime.datetime end_time: End of the interval to query.
         :param str environment: One of 'prod' or 'dev'.
         :param dict metric_label_filters: Optionally, only return metrics
             that match these label key/vals.
         :param int page_size: Max number of points returned per page (this
             is handled transparently).
+        :param Aggregation aggregation: Optionally, have the backend
+            aggregate the points before returning them. See
+            :py:func:`build_aggregation`.
         :rtype: generator
         :return: A generator of metric point dicts.
         """
-        client = get_metrics_client()
-        md_name, md_type, project_resource = cls._get_metric_vars()
-        filter_str = (
-            'metric.type="{}" AND metric.label.environment="{}"'.format(
-                md_type, environment))
-        if metric_label_filters:
-            for label_name, label_val in metric_label_filters.items():
-                filter_str += ' AND metric.label.{}="{}"'.format(
-                    label_name, label_val)
-
-        next_page_token = None
-        # Automatically paginate through the metric results.
-        while True:
-            request = client.projects().timeSeries().list(
-                name=project_resource,
-                filter=filter_str,
-                pageSize=page_size,
-                interval_startTime=format_rfc3339(start_time),
-                interval_endTime=format_rfc3339(end_time),
-                pageToken=next_page_token)
-
-            response = request.execute()
-            next_page_token = response.get('nextPageToken')
-            num_timeseries = len(response['timeSeries'])
-            assert num_timeseries == 1, "Metrics query returned %s time " \
-                                        "series instead of 1. Check your " \
-                                        "filters." % num_timeseries
-            points = response['timeSeries'][0]['points']
+        timeseries_iter = cls._iter_timeseries(
+            start_time, end_time, environment=environment,
+            metric_label_filters=metric_label_filters, page_size=page_size,
+            aggregation=aggregation)
+        for points in _iter_single_series_points(timeseries_iter):
             for point in points:
-                value = point['value'][cls._value_type_to_typed_value()]
-                # If we don't expand our return values much more, may be
-                # better to do a tuple instead.
-                yield {
-                    'time': parse_rfc3339(point['interval']['startTime']),
-                    'value': cls._cast_value_according_to_type(value),
-                }
+                yield cls._parse_point(point)
+
+    @classmethod
+    def query_gauge_by_label(cls, group_by_label, start_time, end_time,
+                             environment='prod', metric_label_filters=None,
+                             page_size=1000, aggregation=None):
+        """
+        Same as :py:meth:`query_gauge`, but returns many time series in one
+        query, grouped by one of their labels. For example, every
+        sub-Reddit's points in a category at once::
+
+            SubRedditSubscribers.query_gauge_by_label(
+                'subreddit', start_time, end_time,
+                metric_label_filters={'subreddit': one_of(slugs)})
+
+        :param str group_by_label: The label to group the points by.
+        :param datetime.datetime start_time: Beginning of the interval to
+            query.
+        :param datetime.datetime end_time: End of the interval to query.
+        :param str environment: One of 'prod' or 'dev'.
+        :param dict metric_label_filters: Optionally, only return metrics
+            that match these label key/vals. Values may be a
+            :py:class:`techsubs.metrics.backends.base.one_of` set, to match
+            any of several values.
+        :param int page_size: Max number of results returned per page (this
+            is handled transparently).
+        :param Aggregation aggregation: Optionally, have the backend
+            aggregate the points before returning them. See
+            :py:func:`build_aggregation`.
+            If it reduces across series, only the labels in its
+            group_by_fields are left to group by.
+        :rtype: dict
+        :return: A dict of label values to lists of metric point dicts.
+            Label values with no points in the interval are omitted.
+        """
+        grouped_points = {}
+        timeseries_iter = cls._iter_timeseries(
+            start_time, end_time, environment=environment,
+            metric_label_filters=metric_label_filters, page_size=page_size,
+            aggregation=aggregation)
+        for labels, points in timeseries_iter:
+            grouped_points.setdefault(labels.get(group_by_label), []).extend(
+                cls._parse_point(point) for point in points)
+        return grouped_points
+
+    @classmethod
+    def query_gauge_columns(cls, start_time, end_time, environment='prod',
+                            metric_label_filters=None, page_size=1000,
+                            aggregation=None):
+        """
+        Same as :py:meth:`query_gauge`, but returns the points as a pair of
+        compact columns instead of a dict per point. Use this for long
+        ranges with lots of points.
+
+        :param datetime.datetime start_time: Beginning of the interval to
+            query.
+        :param datetime.datetime end_time: End of the interval to query.
+        :param str environment: One of 'prod' or 'dev'.
+        :param dict metric_label_filters: Optionally, only return metrics
+            that match these label key/vals.
+        :param int page_size: Max number of points returned per page (this
+            is handled transparently).
+        :param Aggregation aggregation: Optionally, have the backend
+            aggregate the points before returning them. See
+            :py:func:`build_aggregation`.
+        :rtype: tuple
+        :return: Tuple in the form of: times, values. See
+            :py:class:`PointColumns`.
+        """
+        columns = PointColumns()
+        timeseries_iter = cls._iter_timeseries(
+            start_time, end_time, environment=environment,
+            metric_label_filters=metric_label_filters, page_size=page_size,
+            aggregation=aggregation)
+        for points in _iter_single_series_points(timeseries_iter):
+            columns.extend(points, cls._value_type_to_typed_value())
+        return columns.get_columns()
+
+    @classmethod
+    def query_gauge_columns_by_label(cls, group_by_label, start_time,
+                                     end_time, environment='prod',
+                                     metric_label_filters=None,
+                                     page_size=1000, aggregation=None):
+        """
+        Same as :py:meth:`query_gauge_by_label`, but with each label value's
+        points as a pair of compact columns. See
+        :py:meth:`query_gauge_columns`.
+
+        :param str group_by_label: The label to group the points by.
+        :param datetime.datetime start_time: Beginning of the interval to
+            query.
+        :param datetime.datetime end_time: End of the interval to query.
+        :param str environment: One of 'prod' or 'dev'.
+        :param dict metric_label_filters: Optionally, only return metrics
+            that match these label key/vals. Values may be a
+            :py:class:`techsubs.metrics.backends.base.one_of` set, to match
+            any of several values.
+        :param int page_size: Max number of results returned per page (this
+            is handled transparently).
+        :param Aggregation aggregation: Optionally, have the backend
+            aggregate the points before returning them. See
+            :py:func:`build_aggregation`.
+        :rtype: dict
+        :return: A dict of label values to (times, values) tuples. Label
+            values with no points in the interval are omitted.
+        """
+        grouped_columns = {}
+        typed_value_key = cls._value_type_to_typed_value()
+        timeseries_iter = cls._iter_timeseries(
+            start_time, end_time, environment=environment,
+            metric_label_filters=metric_label_filters, page_size=page_size,
+            aggregation=aggregation)
+        for labels, points in timeseries_iter:
+            columns = grouped_columns.get(labels.get(group_by_label))
+            if columns is None:
+                columns = PointColumns()
+                grouped_columns[labels.get(group_by_label)] = columns
+            columns.extend(points, typed_value_key)
+        return {label_value: columns.get_columns()
+                for label_value, columns in grouped_columns.items()}
+
+    @classmethod
+    def _iter_timeseries(cls, start_time, end_time, environment='prod',
+                         metric_label_filters=None, page_size=100,
+                         aggregation=None):
+        """
+        Lists the gauge's time series in an interval from the metrics
+        backend.
+
+        :param datetime.datetime start_time: Beginning of the interval to
+            query.
+        :param datetime.datetime end_time: End of the interval to query.
+        :param str environment: One of 'prod' or 'dev'.
+        :param dict metric_label_filters: Optionally, only return metrics
+            that match these label key/vals.
+        :param int page_size: Max number of results returned per page.
+        :param Aggregation aggregation: Optionally, how to aggregate the
+            points. See :py:func:`build_aggregation`.
+        :rtype: generator
+        :return: A generator of tuples in the form of: labels, points. The
+            points are raw Point dicts.
+        """
+        md_name, md_type, project_resource = cls._get_metric_vars()
+        metric_filter = build_metric_filter(
+            md_type, environment, metric_label_filters)
+        return get_metrics_backend().list_timeseries(
+            metric_filter, start_time, end_time, aggregation=aggregation,
+            page_size=page_size)
 
-            if not next_page_token:
-                break
+    @classmethod
+    def _parse_point(cls, point):
+        """
+        :param dict point: A Point dict from a timeSeries.list response.
+        :rtype: dict
+        :return: A metric point dict.
+        """
+        interval = point['interval']
+        typed_value = point['value']
+        typed_value_key = cls._value_type_to_typed_value()
+        if typed_value_key in typed_value:
+            value = cls._cast_value_according_to_type(
+                typed_value[typed_value_key])
+        else:
+            # Some aligners (ALIGN_MEAN, for one) always come back as doubles.
+            value = float(typed_value['doubleValue'])
+        # If we don't expand our return values much more, may be
+        # better to do a tuple instead.
+        return {
+            # Aligned gauge points may only have an end time.
+            'time': parse_rfc3339(
+                interval.get('startTime') or interval['endTime']),
+            'value': value,
+        }
+
+
+class CumulativeMetric(BaseMetric):
+    """
+    Tracks a running total. Each point covers everything since the total
+    started counting (or was last reset).
+    """
+    metric_kind = 'CUMULATIVE'
+
+    @classmethod
+    def write_cumulative(cls, value, start_time, labels=None,
+                         time_override=None):
+        """
+        Send a running total to Google Metrics.
+
+        :param value: The total since ``start_time``.
+        :param datetime.datetime start_time: When the total started counting.
+            Keep this the same for every point in a time series, until the
+            total resets. Remember, UTC!
+        :param dict labels: An optional dict of labels to apply to the point.
+        :param datetime.datetime time_override: If the point should fall
+            outside of the current time, pass it in here. Remember, UTC!
+        :raises: ValueError if the point doesn't end after ``start_time``.
+        """
+        cls._validate_labels(labels)
+        end_time = time_override or datetime.datetime.utcnow()
+        if end_time <= start_time:
+            raise ValueError(
+                "Cumulative points must end after their start time.")
+        interval = (format_rfc3339(start_time), format_rfc3339(end_time))
+        cls._write_value(value, interval, labels=labels)
+
+
+class DeltaMetric(BaseMetric):
+    """
+    Tracks the change in a value over an interval. Unlike a
+    :py:class:`CumulativeMetric`, each point only covers its own interval.
+    A time series' intervals may not overlap.
+
+    .. warning:: Google Metrics doesn't allow custom DELTA metrics, so these
+        only work with the SQLite metrics backend for now.
+    """
+    metric_kind = 'DELTA'
+
+    @classmethod
+    def write_delta(cls, value, start_time, end_time, labels=None):
+        """
+        Send the change over an interval to the metrics backend.
+
+        :param value: The change between ``start_time`` and ``end_time``.
+        :param datetime.datetime start_time: Beginning of the interval.
+        :param datetime.datetime end_time: End of the interval.
+        :param dict labels: An optional dict of labels to apply to the point.
+        :raises: ValueError if the interval is empty.
+        """
+        cls._validate_labels(labels)
+        if end_time <= start_time:
+            raise ValueError("Delta points must end after their start time.")
+        interval = (format_rfc3339(start_time), format_rfc3339(end_time))
+        cls._write_value(value, interval, labels=labels)
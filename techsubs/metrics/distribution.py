@@ -0,0 +1,153 @@
+"""
+Client-side bucketing for DISTRIBUTION metrics. A whole population of
+values (say, the score of every new post in an hour) gets summarized into a
+single Distribution point, so it costs no more to send than one count.
+
+See the Distribution type in
+https://cloud.google.com/monitoring/api/ref_v3/rest/v3/TypedValue
+"""
+import bisect
+
+
+def build_linear_buckets(num_finite_buckets, width, offset=0):
+    """
+    Buckets of equal width, starting at ``offset``.
+
+    :param int num_finite_buckets: How many buckets to have, not counting
+        the underflow and overflow buckets.
+    :param width: How wide each bucket is.
+    :param offset: The lower bound of the first finite bucket.
+    :rtype: dict
+    :returns: A BucketOptions dict.
+    """
+    return {
+        'linearBuckets': {
+            'numFiniteBuckets': num_finite_buckets,
+            'width': width,
+            'offset': offset,
+        }
+    }
+
+
+def build_exponential_buckets(num_finite_buckets, growth_factor, scale=1):
+    """
+    Buckets that get wider as they go up. These are usually what you want
+    for long-tailed values, like post scores.
+
+    :param int num_finite_buckets: How many buckets to have, not counting
+        the underflow and overflow buckets.
+    :param growth_factor: How much wider each bucket is than the last.
+    :param scale: The lower bound of the first finite bucket.
+    :rtype: dict
+    :returns: A BucketOptions dict.
+    """
+    return {
+        'exponentialBuckets': {
+            'numFiniteBuckets': num_finite_buckets,
+            'growthFactor': growth_factor,
+            'scale': scale,
+        }
+    }
+
+
+def build_explicit_buckets(bounds):
+    """
+    :param list bounds: The boundaries between buckets, in increasing order.
+    :rtype: dict
+    :returns: A BucketOptions dict.
+    """
+    return {
+        'explicitBuckets': {
+            'bounds': list(bounds),
+        }
+    }
+
+
+def get_bucket_bounds(bucket_options):
+    """
+    :param dict bucket_options: A BucketOptions dict.
+    :rtype: list
+    :returns: The boundaries between buckets, in increasing order. Bucket
+        ``i`` covers ``[bounds[i - 1], bounds[i])``, with an underflow
+        bucket below the first bound and an overflow bucket above the last.
+    :raises: ValueError if the bucket options aren't recognized.
+    """
+    if 'linearBuckets' in bucket_options:
+        options = bucket_options['linearBuckets']
+        return [options['offset'] + options['width'] * i
+                for i in range(options['numFiniteBuckets'] + 1)]
+    elif 'exponentialBuckets' in bucket_options:
+        options = bucket_options['exponentialBuckets']
+        return [options['scale'] * options['growthFactor'] ** i
+                for i in range(options['numFiniteBuckets'] + 1)]
+    elif 'explicitBuckets' in bucket_options:
+        return list(bucket_options['explicitBuckets']['bounds'])
+    else:
+        raise ValueError('Un-implemented bucket options: %s' % bucket_options)
+
+
+class Distribution(object):
+    """
+    Builds up a Distribution value one sample at a time. The count, mean,
+    spread, and bucket counts are all kept up to date as values are added,
+    so the samples only need to be seen once and are never stored::
+
+        distribution = SubRedditNewPostScoreDistribution.create_distribution()
+        for post in posts:
+            distribution.add(post['score'])
+        SubRedditNewPostScoreDistribution.write_gauge(distribution, ...)
+    """
+    def __init__(self, bucket_options):
+        """
+        :param dict bucket_options: A BucketOptions dict. See
+            :py:func:`build_exponential_buckets` and friends.
+        """
+        self.bucket_options = bucket_options
+        self._bounds = get_bucket_bounds(bucket_options)
+        self.bucket_counts = [0] * (len(self._bounds) + 1)
+        self.count = 0
+        self.mean = 0.0
+        self.sum_of_squared_deviation = 0.0
+
+    def add(self, value):
+        """
+        :param value: A sample to add to the distribution.
+        """
+        # Welford's method, so the spread doesn't need a second pass.
+        self.count += 1
+        delta = value - self.mean
+        self.mean += float(delta) / self.count
+        self.sum_of_squared_deviation += delta * (value - self.mean)
+        self.bucket_counts[bisect.bisect_right(self._bounds, value)] += 1
+
+    def extend(self, values):
+        """
+        :param iterable values: Samples to add to the distribution.
+        """
+        for value in values:
+            self.add(value)
+
+    def to_dict(self):
+        """
+        :rtype: dict
+        :returns: A Distribution dict, ready to send as a point's value.
+        """
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'sumOfSquaredDeviation': self.sum_of_squared_deviation,
+            'bucketOptions': self.bucket_options,
+            'bucketCounts': list(self.bucket_counts),
+        }
+
+
+def build_distribution(values, bucket_options):
+    """
+    :param iterable values: The samples to bucket.
+    :param dict bucket_options: A BucketOptions dict.
+    :rtype: dict
+    :returns: A Distribution dict.
+    """
+    distribution = Distribution(bucket_options)
+    distribution.extend(values)
+    return distribution.to_dict()
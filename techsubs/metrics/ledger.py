@@ -0,0 +1,81 @@
+"""
+A ledger of the metric points that the metrics backend has already accepted.
+Monitoring refuses to write a point twice, so without this a retried scan
+would fail on the points it had already sent. With it, those points are
+skipped, and scans can check up-front whether there's anything left to do.
+
+Points are identified by their metric type, labels, and end time.
+"""
+import json
+import hashlib
+import datetime
+
+from google.appengine.ext import ndb
+
+from techsubs.models import MetricPointLedgerEntry
+
+# How long to remember points for. Retries and re-runs after an outage
+# happen well within this.
+LEDGER_RETENTION = datetime.timedelta(days=2)
+# How many expired entries to delete per pruning pass.
+PRUNE_BATCH_SIZE = 500
+
+
+def get_point_id(metric_type, labels, end_time):
+    """
+    :param str metric_type: The point's metric type.
+    :param dict labels: All of the point's labels.
+    :param str end_time: The point's RFC 3339 end time.
+    :rtype: str
+    :returns: An ID that is unique to the point.
+    """
+    point_json = json.dumps(
+        [metric_type, sorted(labels.items()), end_time])
+    return hashlib.sha1(point_json).hexdigest()
+
+
+def get_timeseries_point_id(timeseries):
+    """
+    :param dict timeseries: A TimeSeries dict with one point.
+    :rtype: str
+    :returns: The point's ID. See :py:func:`get_point_id`.
+    """
+    metric = timeseries['metric']
+    return get_point_id(
+        metric['type'], metric.get('labels', {}),
+        timeseries['points'][0]['interval']['endTime'])
+
+
+def are_points_recorded(point_ids):
+    """
+    :param list point_ids: The IDs of the points to check.
+    :rtype: list
+    :returns: A list of bools, True for each point that has been recorded.
+    """
+    keys = [ndb.Key(MetricPointLedgerEntry, point_id)
+            for point_id in point_ids]
+    return [entry is not None for entry in ndb.get_multi(keys)]
+
+
+def record_points(point_ids):
+    """
+    :param list point_ids: The IDs of the points that were accepted.
+    """
+    ndb.put_multi([MetricPointLedgerEntry(id=point_id)
+                   for point_id in point_ids])
+
+
+def prune_ledger():
+    """
+    Deletes entries older than :py:data:`LEDGER_RETENTION`.
+
+    :rtype: int
+    :returns: How many entries were deleted. If this equals
+        :py:data:`PRUNE_BATCH_SIZE`, there may be more to go.
+    """
+    cutoff = datetime.datetime.utcnow() - LEDGER_RETENTION
+    keys = MetricPointLedgerEntry.query(
+        MetricPointLedgerEntry.recorded < cutoff).fetch(
+        PRUNE_BATCH_SIZE, keys_only=True)
+    ndb.delete_multi(keys)
+    return len(keys)
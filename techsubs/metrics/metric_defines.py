@@ -3,6 +3,14 @@ We may need to break this up into multiple modules eventually, but toss any
 metrics that we need to track in here.
 """
 from techsubs.metrics.common import GaugeMetric
+from techsubs.metrics.distribution import build_exponential_buckets
+
+# Nearly every metric we track is per sub-Reddit.
+SUBREDDIT_LABEL = {
+    "key": "subreddit",
+    "valueType": "STRING",
+    "description": "The sub-Reddit being tracked."
+}
 
 
 class SubRedditSubscribers(GaugeMetric):
@@ -11,13 +19,8 @@ class SubRedditSubscribers(GaugeMetric):
     description = "Total number of subscribers per sub-Reddit."
     metric_value_type = 'INT64'
 
-    extra_labels = [
-        {
-            "key": "subreddit",
-            "valueType": "STRING",
-            "description": "The sub-Reddit being tracked."
-        },
-    ]
+    extra_labels = [SUBREDDIT_LABEL]
+    track_recent_history = True
 
 
 class SubRedditAccountsActive(GaugeMetric):
@@ -26,13 +29,18 @@ class SubRedditAccountsActive(GaugeMetric):
     description = "Currently Active Accounts per sub-Reddit."
     metric_value_type = 'INT64'
 
-    extra_labels = [
-        {
-            "key": "subreddit",
-            "valueType": "STRING",
-            "description": "The sub-Reddit being tracked."
-        },
-    ]
+    extra_labels = [SUBREDDIT_LABEL]
+    track_recent_history = True
+
+
+class SubRedditAccountsActiveMean(GaugeMetric):
+    metric_name = "subreddit.accounts.active.mean"
+    display_name = "Mean Active Accounts"
+    description = "Average of an hour's active account samples per " \
+                  "sub-Reddit. Only sent when sampling is on."
+    metric_value_type = 'DOUBLE'
+
+    extra_labels = [SUBREDDIT_LABEL]
 
 
 class SubRedditNewPostCount(GaugeMetric):
@@ -41,10 +49,59 @@ class SubRedditNewPostCount(GaugeMetric):
     description = "Daily totals of new posts per sub-Reddit."
     metric_value_type = 'INT64'
 
-    extra_labels = [
-        {
-            "key": "subreddit",
-            "valueType": "STRING",
-            "description": "The sub-Reddit being tracked."
-        },
-    ]
+    extra_labels = [SUBREDDIT_LABEL]
+    track_recent_history = True
+
+
+class SubRedditNewPostComments(GaugeMetric):
+    metric_name = "subreddit.posts.new.comments.count"
+    display_name = "Comments on New Posts"
+    description = "Total comments on an hour's new posts per sub-Reddit, " \
+                  "as of when they were scanned."
+    metric_value_type = 'INT64'
+
+    extra_labels = [SUBREDDIT_LABEL]
+
+
+class SubRedditNewPostScoreSum(GaugeMetric):
+    metric_name = "subreddit.posts.new.score.sum"
+    display_name = "New Post Score (Sum)"
+    description = "Combined score of an hour's new posts per sub-Reddit, " \
+                  "as of when they were scanned."
+    metric_value_type = 'INT64'
+
+    extra_labels = [SUBREDDIT_LABEL]
+
+
+class SubRedditNewPostScoreMax(GaugeMetric):
+    metric_name = "subreddit.posts.new.score.max"
+    display_name = "New Post Score (Max)"
+    description = "Highest score among an hour's new posts per sub-Reddit, " \
+                  "as of when they were scanned."
+    metric_value_type = 'INT64'
+
+    extra_labels = [SUBREDDIT_LABEL]
+
+
+class SubRedditNewPostScoreDistribution(GaugeMetric):
+    metric_name = "subreddit.posts.new.score.distribution"
+    display_name = "New Post Score Distribution"
+    description = "Spread of the scores of an hour's new posts per " \
+                  "sub-Reddit, as of when they were scanned."
+    metric_value_type = 'DISTRIBUTION'
+    # Scores are long-tailed. The underflow bucket catches zero and below,
+    # then the buckets double in width up to 65536.
+    bucket_options = build_exponential_buckets(16, 2)
+
+    extra_labels = [SUBREDDIT_LABEL]
+
+
+class SubRedditNewSelfPostCount(GaugeMetric):
+    metric_name = "subreddit.posts.new.self.count"
+    display_name = "New Self Posts"
+    description = "Number of an hour's new posts per sub-Reddit that are " \
+                  "self (text) posts. Divide by New Posts for the ratio."
+    metric_value_type = 'INT64'
+
+    extra_labels = [SUBREDDIT_LABEL]
+
@@ -0,0 +1,316 @@
+"""
+A compact store of recent hourly points per sub-Reddit. Metrics that set
+``track_recent_history`` get their points copied in here as they're
+written, so readers like the category overview can compute peaks, sums, and
+growth over recent windows without querying Google Metrics.
+
+Each sub-Reddit's history for a metric is a ring buffer of hourly int64
+slots, covering the last 24 hours. All of a sub-Reddit's buffers are kept
+together in one :py:class:`techsubs.models.SubredditRollingStats` entity,
+so the overview documents can be built from a single get_multi.
+"""
+import array
+import logging
+import calendar
+
+from google.appengine.ext import ndb
+
+from techsubs.models import SubredditRollingStats
+from techsubs.utils import chunked
+
+# How many hours the rolling stats cover.
+ROLLING_STATS_SLOTS = 24
+# Datastore caps how many entity groups a transaction may touch.
+ROLLING_STATS_PER_TRANSACTION = 25
+# Marks an hour that we don't have a point for.
+MISSING_VALUE = -2 ** 63
+SECONDS_PER_HOUR = 3600
+# Python 2's array module has no 'q', but 'l' is 64-bit on our hosts.
+try:
+    array.array('q')
+    SLOT_TYPECODE = 'q'
+except ValueError:
+    SLOT_TYPECODE = 'l'
+
+
+class HourlyRingBuffer(object):
+    """
+    Hourly values for one sub-Reddit, in a fixed number of slots. Hours are
+    counted from the epoch, and each hour lives in slot hour % slot count.
+    Once the buffer wraps around, the oldest hours are overwritten.
+    """
+    def __init__(self, first_hour=None, newest_hour=None, values=None,
+                 slot_count=ROLLING_STATS_SLOTS):
+        """
+        :param int first_hour: The oldest hour that has ever been set.
+        :param int newest_hour: The newest hour that has been set.
+        :param array.array values: The slots, if we're loading a buffer.
+        :param int slot_count: How many hours a new buffer holds.
+        """
+        self.first_hour = first_hour
+        self.newest_hour = newest_hour
+        if values is None:
+            values = array.array(SLOT_TYPECODE, [MISSING_VALUE]) * \
+                slot_count
+        self.values = values
+
+    @classmethod
+    def from_blob(cls, blob):
+        """
+        :param tuple blob: A value from :py:meth:`to_blob`.
+        :rtype: HourlyRingBuffer
+        """
+        first_hour, newest_hour, values_str = blob
+        values = array.array(SLOT_TYPECODE)
+        values.fromstring(values_str)
+        return cls(first_hour, newest_hour, values)
+
+    def to_blob(self):
+        """
+        :rtype: tuple
+        :returns: A compact, picklable form of the buffer.
+        """
+        return self.first_hour, self.newest_hour, self.values.tostring()
+
+    def set(self, hour, value):
+        """
+        :param int hour: The hour (since the epoch) the value is for.
+        :param int value: The value to store.
+        """
+        slot_count = len(self.values)
+        if self.newest_hour is None:
+            self.first_hour = self.newest_hour = hour
+        elif hour > self.newest_hour:
+            # Clear out the slots we skipped over, so they don't show
+            # values from the last time around the ring.
+            for skipped_hour in range(
+                    max(self.newest_hour + 1, hour - slot_count + 1), hour):
+                self.values[skipped_hour % slot_count] = MISSING_VALUE
+            self.newest_hour = hour
+        elif hour <= self.newest_hour - slot_count:
+            # Too old to fit.
+            return
+        self.first_hour = min(self.first_hour, hour)
+        self.values[hour % slot_count] = value
+
+    def covers(self, start_hour):
+        """
+        :param int start_hour: The first hour of a window.
+        :rtype: bool
+        :returns: True if we were already tracking the sub-Reddit at the
+            start of the window, and still have it in the buffer. Windows
+            we don't cover need to be read from Google Metrics instead.
+        """
+        if self.newest_hour is None:
+            return False
+        return self.first_hour <= start_hour and \
+            start_hour > self.newest_hour - len(self.values)
+
+    def iter_window(self, start_hour, end_hour):
+        """
+        :param int start_hour: The first hour of the window.
+        :param int end_hour: The last hour of the window (inclusive).
+        :rtype: generator
+        :returns: A generator of (hour, value) tuples for the hours in the
+            window that we have values for, oldest first.
+        """
+        if self.newest_hour is None:
+            return
+        slot_count = len(self.values)
+        start_hour = max(start_hour, self.newest_hour - slot_count + 1)
+        end_hour = min(end_hour, self.newest_hour)
+        values = self.values
+        for hour in range(start_hour, end_hour + 1):
+            value = values[hour % slot_count]
+            if value != MISSING_VALUE:
+                yield hour, value
+
+    def get_peak(self, start_hour, end_hour):
+        """
+        :rtype: int
+        :returns: The biggest value in the window, or 0 if there are none.
+        """
+        return max([value for _, value in
+                    self.iter_window(start_hour, end_hour)] or [0])
+
+    def get_total(self, start_hour, end_hour):
+        """
+        :rtype: int
+        :returns: The sum of the values in the window.
+        """
+        return sum(value for _, value in
+                   self.iter_window(start_hour, end_hour))
+
+    def get_oldest_and_newest(self, start_hour, end_hour):
+        """
+        :rtype: tuple
+        :returns: Tuple in the form of: oldest_value, newest_value. Both are
+            None if there are no values in the window.
+        """
+        window_values = [value for _, value in
+                         self.iter_window(start_hour, end_hour)]
+        if not window_values:
+            return None, None
+        return window_values[0], window_values[-1]
+
+
+def get_hour(dt):
+    """
+    :param datetime.datetime dt: A naive UTC datetime.
+    :rtype: int
+    :returns: The hour (since the epoch) that the datetime falls in.
+    """
+    return calendar.timegm(dt.utctimetuple()) // SECONDS_PER_HOUR
+
+
+def update_recent_history(metric_points, environment):
+    """
+    Adds newly written points to the rolling stats. This is best-effort,
+    since Google Metrics still has everything. Sub-Reddits whose update
+    fails have their rolling stats dropped, so nobody reads a window with
+    a hole in it.
+
+    :param list metric_points: (metric, subreddit_name, hour, value) tuples.
+        Points for metrics that don't track recent history are ignored.
+    :param str environment: The environment the points were written for.
+    """
+    points_by_subreddit = {}
+    for metric, subreddit_name, hour, value in metric_points:
+        if metric.track_recent_history:
+            points_by_subreddit.setdefault(subreddit_name, []).append(
+                (metric.metric_name, hour, value))
+
+    subreddit_names = sorted(points_by_subreddit)
+    for names_chunk in chunked(
+            subreddit_names, ROLLING_STATS_PER_TRANSACTION):
+        points_by_key = {_get_rolling_stats_key(name, environment):
+                         points_by_subreddit[name] for name in names_chunk}
+        try:
+            _update_rolling_stats(points_by_key)
+        except Exception:
+            logging.exception(
+                "Failed to update rolling stats for: %s",
+                ', '.join(names_chunk))
+            _drop_rolling_stats(list(points_by_key.keys()))
+
+
+def get_rolling_stats(subreddit_names, environment='prod'):
+    """
+    Looks up the last 24 hours of every tracked metric for a batch of
+    sub-Reddits, in one get_multi.
+
+    :param list subreddit_names: The sub-Reddits to look up.
+    :param str environment: One of 'prod' or 'dev'.
+    :rtype: dict
+    :returns: A dict of sub-Reddit names to dicts of metric names to
+        :py:class:`HourlyRingBuffer`. Sub-Reddits without any rolling stats
+        yet are omitted.
+    """
+    keys = [_get_rolling_stats_key(name, environment)
+            for name in subreddit_names]
+    rolling_stats = {}
+    for name, entity in zip(subreddit_names, ndb.get_multi(keys)):
+        if entity is None or not entity.buffers:
+            continue
+        rolling_stats[name] = {
+            metric_name: HourlyRingBuffer.from_blob(blob)
+            for metric_name, blob in entity.buffers.items()}
+    return rolling_stats
+
+
+@ndb.transactional(xg=True)
+def _update_rolling_stats(points_by_key):
+    """
+    :param dict points_by_key: A dict of SubredditRollingStats keys to lists
+        of (metric_name, hour, value) tuples to add.
+    """
+    keys = list(points_by_key.keys())
+    entities = []
+    for key, entity in zip(keys, ndb.get_multi(keys)):
+        entity = entity or SubredditRollingStats(key=key)
+        buffers = entity.buffers or {}
+        for metric_name, hour, value in points_by_key[key]:
+            blob = buffers.get(metric_name)
+            ring = HourlyRingBuffer.from_blob(blob) if blob else \
+                HourlyRingBuffer()
+            ring.set(hour, value)
+            buffers[metric_name] = ring.to_blob()
+        entity.buffers = buffers
+        # Marks the sub-Reddit dirty.
+        entity.version += 1
+        entities.append(entity)
+    ndb.put_multi(entities)
+
+
+def _drop_rolling_stats(keys):
+    """
+    Throws out rolling stats that are missing points, rather than leave
+    them to quietly undercount. Until a new set covers the whole window,
+    readers go to Google Metrics for these sub-Reddits instead.
+
+    :param list keys: The SubredditRollingStats keys to drop.
+    """
+    try:
+        ndb.delete_multi(keys)
+    except Exception:
+        logging.exception("Failed to drop rolling stats.")
+
+
+def get_dirty_subreddits(subreddit_names, environment='prod'):
+    """
+    :param list subreddit_names: The sub-Reddits to check.
+    :param str environment: One of 'prod' or 'dev'.
+    :rtype: dict
+    :returns: A dict of the sub-Reddits that have gotten new points since
+        their overview documents were last published, to their rolling
+        stats versions. Pass this to :py:func:`clear_dirty_subreddits` once
+        the documents are published.
+    """
+    keys = [_get_rolling_stats_key(name, environment)
+            for name in subreddit_names]
+    return {name: entity.version for name, entity
+            in zip(subreddit_names, ndb.get_multi(keys))
+            if entity and entity.version != entity.published_version}
+
+
+def clear_dirty_subreddits(versions, environment='prod'):
+    """
+    Marks sub-Reddits as published, up to the versions that were read
+    before their documents were generated. Sub-Reddits that got new points
+    since then stay dirty.
+
+    :param dict versions: A dict of sub-Reddit names to rolling stats
+        versions, from :py:func:`get_dirty_subreddits`.
+    :param str environment: One of 'prod' or 'dev'.
+    """
+    subreddit_names = sorted(versions)
+    for names_chunk in chunked(
+            subreddit_names, ROLLING_STATS_PER_TRANSACTION):
+        _set_published_versions({
+            _get_rolling_stats_key(name, environment): versions[name]
+            for name in names_chunk})
+
+
+@ndb.transactional(xg=True)
+def _set_published_versions(versions_by_key):
+    """
+    :param dict versions_by_key: A dict of SubredditRollingStats keys to
+        the versions that were published.
+    """
+    keys = list(versions_by_key.keys())
+    entities = [entity for entity in ndb.get_multi(keys) if entity]
+    for entity in entities:
+        entity.published_version = max(
+            entity.published_version, versions_by_key[entity.key])
+    ndb.put_multi(entities)
+
+
+def _get_rolling_stats_key(subreddit_name, environment):
+    """
+    :param str subreddit_name: The sub-Reddit the stats are for.
+    :param str environment: One of 'prod' or 'dev'.
+    :rtype: ndb.Key
+    """
+    return ndb.Key(SubredditRollingStats,
+                   '{}:{}'.format(environment, subreddit_name))
+
@@ -1,3 +1,91 @@
+"""
+Datastore models. ndb fronts all of these with memcache for us, so most
+lookups never make it to Datastore.
+"""
 import datetime
 
 from google.appengine.ext import ndb
+
+
+class SubredditPostWatermark(ndb.Model):
+    """
+    The newest post that the post stats scanner has already counted for a
+    sub-Reddit. The next scan only has to ask Reddit for posts newer than
+    this. Keyed on the sub-Reddit's name.
+    """
+    fullname = ndb.StringProperty(indexed=False)
+    created_utc = ndb.IntegerProperty(indexed=False)
+    last_modified = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+    @property
+    def created_time(self):
+        """
+        :rtype: datetime.datetime
+        :returns: When the watermark post was created (UTC).
+        """
+        return datetime.datetime.utcfromtimestamp(self.created_utc)
+
+    @classmethod
+    def get_for_subreddits(cls, subreddit_names):
+        """
+        :param list subreddit_names: The sub-Reddits to look up.
+        :rtype: dict
+        :returns: A dict of sub-Reddit names to watermarks. Sub-Reddits that
+            don't have a watermark yet are omitted.
+        """
+        keys = [ndb.Key(cls, name) for name in subreddit_names]
+        return {name: watermark for name, watermark
+                in zip(subreddit_names, ndb.get_multi(keys)) if watermark}
+
+    @classmethod
+    def set_for_subreddits(cls, newest_posts):
+        """
+        :param dict newest_posts: A dict of sub-Reddit names to the newest
+            post 'data' dict counted for each.
+        """
+        ndb.put_multi([
+            cls(id=name, fullname=post['name'],
+                created_utc=int(post['created_utc']))
+            for name, post in newest_posts.items()])
+
+
+class MetricPointLedgerEntry(ndb.Model):
+    """
+    Records that the metrics backend has accepted a point, so that writing
+    it again can be skipped. Keyed on a hash of the point's metric type,
+    labels, and time. See :py:mod:`techsubs.metrics.ledger`.
+    """
+    # Indexed so that old entries can be pruned.
+    recorded = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class SubredditRollingStats(ndb.Model):
+    """
+    The last 24 hours of points for every recent history tracked metric,
+    for one sub-Reddit. Kept up to date as the scanners write points, so
+    that the overview documents can be built without any time series
+    queries. Keyed on the environment and the sub-Reddit's name. See
+    :py:mod:`techsubs.metrics.recent_history`.
+    """
+    # A dict of metric names to serialized ring buffers.
+    buffers = ndb.PickleProperty(indexed=False)
+    # Bumped every time new points come in. The sub-Reddit is dirty (its
+    # overview documents are out of date) until published_version catches
+    # up.
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    published_version = ndb.IntegerProperty(default=0, indexed=False)
+    last_modified = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+class DocumentManifest(ndb.Model):
+    """
+    Every uploaded static document's content hash and version. This is the
+    source of truth for the manifest in Google Storage, since concurrent
+    populators can merge into it transactionally. Keyed on the manifest's
+    GCS URI. See :py:mod:`techsubs.bucket_populator.uploader`.
+    """
+    # A dict of GCS URIs to dicts with the document's hash and version.
+    documents = ndb.JsonProperty(compressed=True)
+    # Bumped on every merge, so an older copy never overwrites a newer one.
+    revision = ndb.IntegerProperty(default=0, indexed=False)
+    last_modified = ndb.DateTimeProperty(auto_now=True, indexed=False)
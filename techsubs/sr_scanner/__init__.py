@@ -9,5 +9,12 @@ functions that the other sub-modules use.
 """
 # The sub-modules in here are purely organizational. You'll want to import
 # and use the stuff exposed below through this sr_scanner module.
-from techsubs.sr_scanner.post_stats import calc_and_send_subreddit_post_stats  # noqa
-from techsubs.sr_scanner.basic_stats import calc_and_send_basic_subreddit_stats  # noqa
+from techsubs.sr_scanner.post_stats import (  # noqa
+    calc_and_send_subreddit_post_stats,
+    calc_and_send_subreddit_post_stats_batch)
+from techsubs.sr_scanner.basic_stats import (  # noqa
+    calc_and_send_basic_subreddit_stats,
+    calc_and_send_basic_subreddit_stats_batch,
+    sample_accounts_active_batch)
+from techsubs.sr_scanner.combined_stats import (  # noqa
+    calc_and_send_combined_subreddit_stats)
@@ -2,12 +2,52 @@
 This module contains everything needed to calculate some basic, higher-level
 stats for a sub-Reddit.
 """
+import logging
 import datetime
 
+from google.appengine.api import memcache
+
+from techsubs import app
+from techsubs.metrics.common import MetricBatch
 from techsubs.metrics.metric_defines import SubRedditSubscribers, \
-    SubRedditAccountsActive
+    SubRedditAccountsActive, SubRedditAccountsActiveMean
 from techsubs.sr_scanner.common import get_subreddit_about_dict, \
-    get_subreddit_metric_labels
+    get_subreddit_about_dicts, get_subreddit_metric_labels, \
+    get_current_hour_floor, get_unsent_subreddits
+
+# Everything we send from the about info, for each sub-Reddit.
+BASIC_STATS_METRICS = [SubRedditSubscribers, SubRedditAccountsActive]
+# What the hourly roll-up of the active account samples sends.
+ACCOUNTS_ACTIVE_SAMPLE_METRICS = [
+    SubRedditAccountsActive, SubRedditAccountsActiveMean]
+# Memcache key prefix for an hour's active account samples. Formatted with
+# the hour.
+ACCOUNTS_ACTIVE_SAMPLES_KEY_PREFIX = 'sr-active-samples:{:%Y%m%d%H}:'
+# Long enough for an hour's samples to outlive a few failed roll-ups.
+ACCOUNTS_ACTIVE_SAMPLES_TTL = 3 * 60 * 60
+# Give up on folding in a sample after this many compare-and-set collisions.
+ACCOUNTS_ACTIVE_SAMPLE_MAX_CAS_ATTEMPTS = 10
+
+
+def is_sampling_accounts_active():
+    """
+    :rtype: bool
+    :returns: True if accounts_active comes from the high-frequency
+        samples, rather than the hourly scans.
+    """
+    return app.config['SAMPLE_ACCOUNTS_ACTIVE']
+
+
+def get_basic_stats_metrics():
+    """
+    :rtype: list
+    :returns: The metrics that the hourly basic stats scan sends. The
+        sampled ones are left out when sampling is on.
+    """
+    if is_sampling_accounts_active():
+        return [metric for metric in BASIC_STATS_METRICS
+                if metric not in ACCOUNTS_ACTIVE_SAMPLE_METRICS]
+    return BASIC_STATS_METRICS
 
 
 def calc_and_send_basic_subreddit_stats(subreddit_name):
@@ -20,15 +60,58 @@ def calc_and_send_basic_subreddit_stats(subreddit_name):
     """
     # We can fetch /r/srname/about.json once, then extract a few metrics.
     sr_about = get_subreddit_about_dict(subreddit_name)
+    _send_basic_subreddit_stats(
+        subreddit_name, sr_about, get_current_hour_floor())
+
+
+def calc_and_send_basic_subreddit_stats_batch(subreddit_names):
+    """
+    Same as :py:func:`calc_and_send_basic_subreddit_stats`, but looks up
+    many sub-Reddits per Reddit API request. The points are sent together
+    in a :py:class:`MetricBatch`.
+
+    :param list subreddit_names: The sub-Reddits to report basic stats for.
+    :raises: MetricWriteError if any of the points failed to write.
+    """
+    hour_floor = get_current_hour_floor()
+    subreddit_names = get_unsent_subreddits(
+        get_basic_stats_metrics(), subreddit_names, hour_floor)
+    if not subreddit_names:
+        return
+    about_dicts = get_subreddit_about_dicts(subreddit_names)
+    with MetricBatch() as metric_batch:
+        for subreddit_name in subreddit_names:
+            sr_about = about_dicts.get(subreddit_name)
+            if sr_about is None:
+                logging.warning(
+                    "No info returned for sub-Reddit: %s", subreddit_name)
+                continue
+            try:
+                _send_basic_subreddit_stats(
+                    subreddit_name, sr_about, hour_floor)
+            except (KeyError, TypeError, ValueError):
+                # IE: Reddit sent a null accounts_active.
+                logging.warning(
+                    "Bad info returned for sub-Reddit: %s", subreddit_name)
+    metric_batch.raise_for_errors()
+
+
+def _send_basic_subreddit_stats(subreddit_name, sr_about, hour_floor):
+    """
+    :param str subreddit_name: The sub-Reddit to report basic stats for.
+    :param dict sr_about: An unmarshalled sub-Reddit about.json 'data' dict.
+    :param datetime.datetime hour_floor: The hour to report the stats for.
+    """
     sub_count, accounts_active = _calc_basic_subreddit_stats(sr_about)
 
     metric_labels = get_subreddit_metric_labels(subreddit_name)
     # time_override is specified so that we can't double-report an hour.
-    hour_floor = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
     SubRedditSubscribers.write_gauge(
         sub_count, labels=metric_labels, time_override=hour_floor)
-    SubRedditAccountsActive.write_gauge(
-        accounts_active, labels=metric_labels, time_override=hour_floor)
+    # The samples' hourly roll-up covers this, when sampling is on.
+    if not is_sampling_accounts_active():
+        SubRedditAccountsActive.write_gauge(
+            accounts_active, labels=metric_labels, time_override=hour_floor)
 
 
 def _calc_basic_subreddit_stats(sr_about):
@@ -40,3 +123,121 @@ def _calc_basic_subreddit_stats(sr_about):
     sub_count = int(sr_about['subscribers'])
     accounts_active = int(sr_about['accounts_active'])
     return sub_count, accounts_active
+
+
+def sample_accounts_active_batch(subreddit_names):
+    """
+    Takes one active account sample for each of a batch of sub-Reddits.
+    Run this every few minutes. The samples are folded into a running
+    count, total, and peak in memcache, so a burst of activity between
+    hourly scans isn't missed.
+
+    Nothing is sent to Google Metrics until the hour is over. The first run
+    of the next hour rolls the samples up into a single peak and mean
+    point per sub-Reddit.
+
+    :param list subreddit_names: The sub-Reddits to sample.
+    :raises: MetricWriteError if the previous hour's roll-up failed to
+        write. Its samples are kept, so a retry can send them.
+    """
+    hour_floor = get_current_hour_floor()
+    prev_hour_floor = hour_floor - datetime.timedelta(hours=1)
+    _send_accounts_active_rollup(subreddit_names, prev_hour_floor)
+
+    about_dicts = get_subreddit_about_dicts(subreddit_names)
+    accounts_active_by_name = {}
+    for subreddit_name, sr_about in about_dicts.items():
+        try:
+            accounts_active_by_name[subreddit_name] = int(
+                sr_about['accounts_active'])
+        except (KeyError, TypeError, ValueError):
+            # Reddit sends a null accounts_active for some sub-Reddits.
+            logging.warning(
+                "No active accounts returned for sub-Reddit: %s",
+                subreddit_name)
+
+    key_prefix = ACCOUNTS_ACTIVE_SAMPLES_KEY_PREFIX.format(hour_floor)
+    # Tasks that back up in the queue can end up sampling the same
+    # sub-Reddits at the same time, so samples are folded in with a
+    # compare-and-set.
+    client = memcache.Client()
+    for _ in range(ACCOUNTS_ACTIVE_SAMPLE_MAX_CAS_ATTEMPTS):
+        accounts_active_by_name = _fold_accounts_active_samples(
+            client, accounts_active_by_name, key_prefix)
+        if not accounts_active_by_name:
+            return
+    logging.warning(
+        "Gave up on active account samples for: %s",
+        ', '.join(accounts_active_by_name))
+
+
+def _fold_accounts_active_samples(client, accounts_active_by_name,
+                                  key_prefix):
+    """
+    Folds one sample per sub-Reddit into the hour's running count, total,
+    and peak.
+
+    :param memcache.Client client: The client to do the compare-and-set
+        with.
+    :param dict accounts_active_by_name: A dict of sub-Reddit names to
+        their sampled active account counts.
+    :param str key_prefix: The hour's samples key prefix.
+    :rtype: dict
+    :returns: The samples that collided with another writer, and need to
+        be tried again.
+    """
+    samples = client.get_multi(
+        list(accounts_active_by_name.keys()), key_prefix=key_prefix,
+        for_cas=True)
+    updated_samples = {}
+    new_samples = {}
+    for subreddit_name, accounts_active in accounts_active_by_name.items():
+        if subreddit_name in samples:
+            count, total, peak = samples[subreddit_name]
+            updated_samples[subreddit_name] = (
+                count + 1, total + accounts_active,
+                max(peak, accounts_active))
+        else:
+            new_samples[subreddit_name] = (
+                1, accounts_active, accounts_active)
+
+    collided_names = []
+    if updated_samples:
+        collided_names += client.cas_multi(
+            updated_samples, key_prefix=key_prefix,
+            time=ACCOUNTS_ACTIVE_SAMPLES_TTL)
+    if new_samples:
+        collided_names += client.add_multi(
+            new_samples, key_prefix=key_prefix,
+            time=ACCOUNTS_ACTIVE_SAMPLES_TTL)
+    return {name: accounts_active_by_name[name] for name in collided_names}
+
+
+def _send_accounts_active_rollup(subreddit_names, hour_floor):
+    """
+    Sends an hour's active account samples as one peak and one mean point
+    per sub-Reddit, then clears them out.
+
+    :param list subreddit_names: The sub-Reddits to send roll-ups for.
+    :param datetime.datetime hour_floor: The hour that was sampled.
+    :raises: MetricWriteError if any of the points failed to write.
+    """
+    key_prefix = ACCOUNTS_ACTIVE_SAMPLES_KEY_PREFIX.format(hour_floor)
+    samples = memcache.get_multi(subreddit_names, key_prefix=key_prefix)
+    if not samples:
+        # Already sent, or nothing was sampled.
+        return
+    sampled_names = [name for name in subreddit_names if name in samples]
+    unsent_names = get_unsent_subreddits(
+        ACCOUNTS_ACTIVE_SAMPLE_METRICS, sampled_names, hour_floor)
+    with MetricBatch() as metric_batch:
+        for subreddit_name in unsent_names:
+            count, total, peak = samples[subreddit_name]
+            metric_labels = get_subreddit_metric_labels(subreddit_name)
+            SubRedditAccountsActive.write_gauge(
+                peak, labels=metric_labels, time_override=hour_floor)
+            SubRedditAccountsActiveMean.write_gauge(
+                float(total) / count, labels=metric_labels,
+                time_override=hour_floor)
+    metric_batch.raise_for_errors()
+    memcache.delete_multi(sampled_names, key_prefix=key_prefix)
@@ -0,0 +1,131 @@
+"""
+This module scans everything we track for a batch of sub-Reddits in a single
+pass. Each upstream resource is fetched once, and every metric is derived
+from those shared responses.
+"""
+import logging
+
+from techsubs.metrics.common import MetricBatch
+from techsubs.metrics.metric_defines import SubRedditSubscribers, \
+    SubRedditAccountsActive
+from techsubs.sr_scanner.basic_stats import is_sampling_accounts_active
+from techsubs.sr_scanner.common import decode_subreddit_info_results, \
+    get_current_hour_floor, get_subreddit_info_urls, \
+    get_subreddit_metric_labels, get_unsent_subreddits, \
+    send_reddit_api_request_async
+from techsubs.sr_scanner.post_stats import \
+    calc_and_send_subreddit_post_stats_batch
+
+# The metrics that we pull out of the sub-Reddit info lookups, along with
+# the field that each is read from.
+ABOUT_METRICS = [
+    (SubRedditSubscribers, 'subscribers'),
+    (SubRedditAccountsActive, 'accounts_active'),
+]
+
+
+def calc_and_send_combined_subreddit_stats(subreddit_names):
+    """
+    Calculates and sends all of our stats for a batch of sub-Reddits. This
+    is equivalent to running both
+    :py:func:`calc_and_send_basic_subreddit_stats_batch` and
+    :py:func:`calc_and_send_subreddit_post_stats_batch`, but in one task.
+
+    Each metric is sent in isolation, so one failing doesn't keep the
+    others from being reported. The about metrics' points all go out
+    together in a :py:class:`MetricBatch`.
+
+    :param list subreddit_names: The sub-Reddits to report stats for.
+    :rtype: list
+    :returns: The names of any metrics that failed to send.
+    :raises: The last error encountered, if every single metric failed.
+        Some points may still have been written (IE: a post stats batch
+        that partially flushed), but the ledger makes retrying safe.
+    """
+    hour_floor = get_current_hour_floor()
+    about_metrics = _get_about_metrics()
+    # If this is a retry, only look up the sub-Reddits we haven't already
+    # sent about metrics for.
+    about_names = get_unsent_subreddits(
+        [metric for metric, _ in about_metrics], subreddit_names, hour_floor)
+    # Get the info lookups in flight first. They'll finish while we page
+    # through the /new listings.
+    info_futures = [send_reddit_api_request_async(url)
+                    for url in get_subreddit_info_urls(about_names)]
+
+    failed_metrics = []
+    last_error = None
+    try:
+        calc_and_send_subreddit_post_stats_batch(subreddit_names)
+    except Exception as exc:
+        logging.exception("Failed to send post stats.")
+        failed_metrics.append('posts')
+        last_error = exc
+
+    about_dicts = {}
+    try:
+        about_dicts = decode_subreddit_info_results(
+            about_names, [future.get_result() for future in info_futures])
+    except Exception as exc:
+        logging.exception("Failed to look up sub-Reddit info.")
+        last_error = exc
+    with MetricBatch() as metric_batch:
+        for metric, field in about_metrics:
+            try:
+                if about_names and not about_dicts:
+                    raise ValueError("No sub-Reddit info to report from.")
+                _send_about_metric(
+                    metric, field, about_names, about_dicts, hour_floor)
+            except Exception as exc:
+                logging.exception("Failed to send %s.", metric.metric_name)
+                failed_metrics.append(metric.metric_name)
+                last_error = exc
+    for failure in metric_batch.errors:
+        if failure.metric.metric_name not in failed_metrics:
+            failed_metrics.append(failure.metric.metric_name)
+        last_error = failure.error
+
+    if len(failed_metrics) == len(about_metrics) + 1:
+        raise last_error
+    return failed_metrics
+
+
+def _get_about_metrics():
+    """
+    :rtype: list
+    :returns: The (metric, field) tuples to send from the info lookups.
+        When sampling is on, accounts_active is sent by the sampler's
+        hourly roll-up instead.
+    """
+    if is_sampling_accounts_active():
+        return [(metric, field) for metric, field in ABOUT_METRICS
+                if metric is not SubRedditAccountsActive]
+    return ABOUT_METRICS
+
+
+def _send_about_metric(metric, field, subreddit_names, about_dicts,
+                       hour_floor):
+    """
+    :param GaugeMetric metric: The metric to send.
+    :param str field: The about 'data' dict field to report.
+    :param list subreddit_names: The sub-Reddits to report for.
+    :param dict about_dicts: A dict of sub-Reddit names to about 'data' dicts.
+    :param datetime.datetime hour_floor: The hour to report the stats for.
+    """
+    for subreddit_name in subreddit_names:
+        sr_about = about_dicts.get(subreddit_name)
+        if sr_about is None:
+            logging.warning(
+                "No info returned for sub-Reddit: %s", subreddit_name)
+            continue
+        try:
+            value = int(sr_about[field])
+        except (KeyError, TypeError, ValueError):
+            # Reddit sends a null accounts_active for some sub-Reddits.
+            logging.warning(
+                "No %s returned for sub-Reddit: %s", field, subreddit_name)
+            continue
+        metric_labels = get_subreddit_metric_labels(subreddit_name)
+        # time_override is specified so that we can't double-report an hour.
+        metric.write_gauge(
+            value, labels=metric_labels, time_override=hour_floor)
@@ -2,9 +2,42 @@
 Logic for scanning sub-Reddits for activity stats.
 """
 import json
+import math
+import calendar
+import datetime
 
+from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import urlfetch
 
+from techsubs.exceptions import RedditAPIError, RedditRateLimitedError
+from techsubs.sr_scanner.rate_limiting import acquire_reddit_request_slot, \
+    back_off_after_rate_limit, update_rate_limit_from_headers
+from techsubs.utils import chunked
+
+# The most Reddit API requests a single worker will have in flight at once.
+REDDIT_MAX_CONCURRENT_REQUESTS = 4
+# Seconds to wait on Reddit before giving up on a request.
+REDDIT_REQUEST_DEADLINE = 15
+# How many times to back off and retry a request that Reddit rate limits.
+REDDIT_MAX_RATE_LIMIT_RETRIES = 3
+# Reddit's /api/info endpoint accepts at most this many comma-separated names.
+REDDIT_INFO_MAX_NAMES = 100
+# The most items that Reddit will return in a single listing page.
+REDDIT_LISTING_MAX_LIMIT = 100
+# Don't bother asking for pages smaller than this. The response overhead
+# dwarfs a handful of extra posts.
+REDDIT_LISTING_MIN_LIMIT = 10
+# Ask for a bit more than we expect to need, so that a slightly busier than
+# usual window still fits in one page.
+LISTING_PAGE_SIZE_HEADROOM = 1.25
+# The only post fields that we read out of a listing. Everything else in
+# the (very chunky) post objects is dropped right after decoding.
+LISTING_POST_FIELDS = [
+    'name', 'created_utc', 'subreddit', 'num_comments', 'score', 'is_self',
+]
+# Same idea, but for the sub-Reddit objects returned by about/info lookups.
+SUBREDDIT_ABOUT_FIELDS = ['display_name', 'subscribers', 'accounts_active']
+
 
 def send_reddit_api_request(url):
     """
@@ -15,12 +48,119 @@ def send_reddit_api_request(url):
     :rtype: google.appengine.api.urlfetch._URLFetchResult
     :returns: The fetched result from App Engine's URL fetch service.
     """
+    return send_reddit_api_request_async(url).get_result()
+
+
+def send_reddit_api_request_async(url, attempt=0):
+    """
+    Same as :py:func:`send_reddit_api_request`, but returns as soon as the
+    request is in flight.
+
+    :param str url: The URL to GET.
+    :param int attempt: How many times this request has already been rate
+        limited.
+    :rtype: RedditRequestFuture
+    :returns: A future for the fetched result.
+    """
     headers = {
         'User-Agent': 'techsubreddits.com by /u/gctaylor',
     }
-    result = urlfetch.fetch(url, headers=headers)
-    assert result.status_code == 200, "Non-200 status code: %s" % result.status_code
-    return result
+    acquire_reddit_request_slot()
+    rpc = urlfetch.create_rpc(deadline=REDDIT_REQUEST_DEADLINE)
+    urlfetch.make_fetch_call(rpc, url, headers=headers)
+    return RedditRequestFuture(rpc, url, attempt=attempt)
+
+
+def send_reddit_api_requests(urls,
+                             max_concurrent=REDDIT_MAX_CONCURRENT_REQUESTS):
+    """
+    Fetches several URLs concurrently, keeping up to ``max_concurrent``
+    requests in flight at a time.
+
+    :param list urls: The URLs to GET.
+    :param int max_concurrent: The most requests to have in flight at once.
+    :rtype: list
+    :returns: The fetched results, in the same order as ``urls``.
+    """
+    results = [None] * len(urls)
+    queued = list(enumerate(urls))
+    in_flight = {}
+    while queued or in_flight:
+        while queued and len(in_flight) < max_concurrent:
+            url_index, url = queued.pop(0)
+            in_flight[send_reddit_api_request_async(url)] = url_index
+        finished = RedditRequestFuture.wait_any(in_flight.keys())
+        results[in_flight.pop(finished)] = finished.get_result()
+    return results
+
+
+class RedditRequestFuture(object):
+    """
+    Wraps an in-flight URL fetch RPC to Reddit.
+    """
+    def __init__(self, rpc, url, attempt=0):
+        """
+        :param google.appengine.api.apiproxy_stub_map.UserRPC rpc: The
+            in-flight URL fetch RPC.
+        :param str url: The URL being fetched.
+        :param int attempt: How many times this request has already been
+            rate limited.
+        """
+        self.rpc = rpc
+        self.url = url
+        self.attempt = attempt
+
+    def get_result(self):
+        """
+        Blocks until the request finishes. If Reddit rate limits us, we back
+        off and transparently retry.
+
+        :rtype: google.appengine.api.urlfetch._URLFetchResult
+        :returns: The fetched result from App Engine's URL fetch service.
+        :raises: RedditRateLimitedError if we're still being rate limited
+            after :py:data:`REDDIT_MAX_RATE_LIMIT_RETRIES` retries.
+        :raises: RedditAPIError for any other non-200 response.
+        """
+        result = self.rpc.get_result()
+        update_rate_limit_from_headers(result.headers)
+        if result.status_code == 429:
+            if self.attempt >= REDDIT_MAX_RATE_LIMIT_RETRIES:
+                raise RedditRateLimitedError(
+                    "Rate limited by Reddit: %s" % self.url)
+            back_off_after_rate_limit(
+                _parse_retry_after(result.headers), self.attempt)
+            retry = send_reddit_api_request_async(
+                self.url, attempt=self.attempt + 1)
+            return retry.get_result()
+        if result.status_code != 200:
+            raise RedditAPIError(
+                "Non-200 status code: %s" % result.status_code)
+        return result
+
+    @classmethod
+    def wait_any(cls, futures):
+        """
+        :param list futures: In-flight :py:class:`RedditRequestFuture`s.
+        :rtype: RedditRequestFuture
+        :returns: The first future whose request has finished.
+        """
+        futures_by_rpc = {future.rpc: future for future in futures}
+        finished_rpc = apiproxy_stub_map.UserRPC.wait_any(
+            futures_by_rpc.keys())
+        return futures_by_rpc[finished_rpc]
+
+
+def _parse_retry_after(headers):
+    """
+    :param dict headers: The response headers from a Reddit API request.
+    :rtype: float or None
+    :returns: The number of seconds that Retry-After asks us to wait, if
+        it was sent in a form we understand.
+    """
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
 
 
 def get_subreddit_about_dict(subreddit_name):
@@ -31,8 +171,223 @@ def get_subreddit_about_dict(subreddit_name):
     """
     url = 'https://www.reddit.com/r/{}/about.json'.format(subreddit_name)
     result_json = send_reddit_api_request(url).content
-    result = json.loads(result_json)
-    return result['data']
+    return project_fields(
+        json.loads(result_json)['data'], SUBREDDIT_ABOUT_FIELDS)
+
+
+def get_subreddit_about_dicts(subreddit_names):
+    """
+    Batched counterpart to :py:func:`get_subreddit_about_dict`. Uses Reddit's
+    info endpoint, which returns the about details for up to
+    :py:data:`REDDIT_INFO_MAX_NAMES` sub-Reddits per request.
+
+    :param list subreddit_names: The sub-Reddits to retrieve specifics about.
+    :rtype: dict
+    :return: A dict whose keys are the sub-Reddit names as passed in, and
+        whose values are the about 'data' dicts. Sub-Reddits that Reddit
+        didn't return anything for (banned, private, typo'd) are omitted.
+    """
+    urls = get_subreddit_info_urls(subreddit_names)
+    return decode_subreddit_info_results(
+        subreddit_names, send_reddit_api_requests(urls))
+
+
+def get_subreddit_info_urls(subreddit_names):
+    """
+    :param list subreddit_names: The sub-Reddits to retrieve specifics about.
+    :rtype: list
+    :return: The Reddit info endpoint URLs needed to look them all up.
+    """
+    return ['https://www.reddit.com/api/info.json?sr_name={}'.format(
+            ','.join(names_chunk))
+            for names_chunk in chunked(subreddit_names, REDDIT_INFO_MAX_NAMES)]
+
+
+def decode_subreddit_info_results(subreddit_names, results):
+    """
+    :param list subreddit_names: The sub-Reddits that were looked up.
+    :param list results: Fetched Reddit info endpoint results.
+    :rtype: dict
+    :return: See :py:func:`get_subreddit_about_dicts`.
+    """
+    # Reddit hands back the canonical capitalization, which doesn't
+    # always match what is in our catalog.
+    names_by_lower = {name.lower(): name for name in subreddit_names}
+    about_dicts = {}
+    for result in results:
+        sr_abouts, _ = decode_listing(result.content, SUBREDDIT_ABOUT_FIELDS)
+        for sr_about in sr_abouts:
+            name = names_by_lower.get(sr_about['display_name'].lower())
+            if name:
+                about_dicts[name] = sr_about
+    return about_dicts
+
+
+def estimate_listing_page_size(expected_items):
+    """
+    :param float expected_items: How many items we expect to need to page
+        through.
+    :rtype: int
+    :return: A listing ``limit`` value that should fit the expected items,
+        with some headroom.
+    """
+    page_size = int(math.ceil(expected_items * LISTING_PAGE_SIZE_HEADROOM))
+    return max(REDDIT_LISTING_MIN_LIMIT,
+               min(page_size, REDDIT_LISTING_MAX_LIMIT))
+
+
+class ListingIterator(object):
+    """
+    Iterates over the posts in a /new listing, newest first, following
+    Reddit's ``after`` cursor from page to page. Iteration stops as soon as
+    a post older than ``oldest_time`` turns up, so we never page (or pay)
+    for much more than the window we care about.
+
+    If ``since_fullname`` is given, we instead walk Reddit's ``before``
+    cursor forward from that post, only fetching posts newer than it. Each
+    page is still newest first, but the pages themselves go from oldest to
+    newest. Reddit also returns nothing for a ``before`` post that has been
+    deleted or removed, so an empty first page falls back to walking back
+    to ``oldest_time``.
+
+    After iterating, :py:attr:`complete` tells you whether the whole window
+    was covered.
+    """
+    def __init__(self, subreddit_path, oldest_time,
+                 page_size=REDDIT_LISTING_MAX_LIMIT, max_pages=None,
+                 since_fullname=None):
+        """
+        :param str subreddit_path: A sub-Reddit name, or several joined by '+'.
+        :param datetime.datetime oldest_time: Stop once we see a post that
+            was created before this time (UTC).
+        :param int page_size: The ``limit`` to use for the first page. Later
+            pages are sized based on the post rate observed so far.
+        :param int max_pages: Optionally, give up after this many pages.
+        :param str since_fullname: Optionally, only fetch posts newer than
+            the post with this fullname (IE: t3_4ovw6c).
+        """
+        self.subreddit_path = subreddit_path
+        self.oldest_timestamp = calendar.timegm(oldest_time.utctimetuple())
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.since_fullname = since_fullname
+        self.pages_fetched = 0
+        self.complete = False
+        self._prefetched_page = None
+
+    def prefetch(self):
+        """
+        Sends the request for the first page right away, without waiting on
+        it. Use this to get several listings in flight at once.
+        """
+        if self.since_fullname:
+            self._prefetched_page = self._start_page_fetch(
+                self.page_size, before=self.since_fullname)
+        else:
+            self._prefetched_page = self._start_page_fetch(self.page_size)
+
+    def __iter__(self):
+        if self.since_fullname:
+            return self._iter_since_fullname()
+        return self._iter_until_oldest_time()
+
+    def _has_pages_left(self):
+        return self.max_pages is None or self.pages_fetched < self.max_pages
+
+    def _iter_since_fullname(self):
+        before = self.since_fullname
+        page_size = self.page_size
+        while self._has_pages_left():
+            posts, _ = self._fetch_page(page_size, before=before)
+            self.pages_fetched += 1
+            if not posts and before == self.since_fullname:
+                # Either nothing is newer, or the post is gone and Reddit
+                # can't page from it. We can't tell which.
+                for post in self._iter_until_oldest_time():
+                    yield post
+                return
+            for post in posts:
+                yield post
+            if len(posts) < page_size:
+                # A short page means there's nothing newer left.
+                self.complete = True
+                return
+            before = posts[0]['name']
+            page_size = REDDIT_LISTING_MAX_LIMIT
+
+    def _iter_until_oldest_time(self):
+        after = None
+        page_size = self.page_size
+        while self._has_pages_left():
+            posts, after = self._fetch_page(page_size, after=after)
+            self.pages_fetched += 1
+            for post in posts:
+                if post['created_utc'] < self.oldest_timestamp:
+                    self.complete = True
+                    return
+                yield post
+            if not after or not posts:
+                # We've reached the end of what Reddit will give us.
+                self.complete = True
+                return
+            page_size = self._calc_next_page_size(posts)
+
+    def _calc_next_page_size(self, posts):
+        """
+        Sizes the next page based on how quickly posts came in on the
+        last one, and how much of the window is left to cover.
+
+        :param list posts: The posts from the last page, newest first.
+        :rtype: int
+        """
+        newest_timestamp = posts[0]['created_utc']
+        oldest_seen_timestamp = posts[-1]['created_utc']
+        elapsed = newest_timestamp - oldest_seen_timestamp
+        if elapsed <= 0:
+            return REDDIT_LISTING_MAX_LIMIT
+        posts_per_second = len(posts) / float(elapsed)
+        remaining = oldest_seen_timestamp - self.oldest_timestamp
+        return estimate_listing_page_size(posts_per_second * remaining)
+
+    def _fetch_page(self, page_size, after=None, before=None):
+        """
+        :param int page_size: The max number of posts to return.
+        :param str after: The fullname of the post to continue after, if any.
+        :param str before: The fullname of the post to return posts newer
+            than, if any.
+        :rtype: tuple
+        :return: Tuple in the form of: posts, after
+        """
+        if self._prefetched_page:
+            # Only ever the first page.
+            page_future = self._prefetched_page
+            self._prefetched_page = None
+        else:
+            page_future = self._start_page_fetch(page_size, after, before)
+        result_json = page_future.get_result().content
+        return decode_listing(result_json, LISTING_POST_FIELDS)
+
+    def _start_page_fetch(self, page_size, after=None, before=None):
+        """
+        See :py:meth:`_fetch_page` for params.
+
+        :rtype: RedditRequestFuture
+        """
+        url = 'https://www.reddit.com/r/{}/new/.json?limit={}'.format(
+            self.subreddit_path, page_size)
+        if after:
+            url += '&after={}'.format(after)
+        if before:
+            url += '&before={}'.format(before)
+        return send_reddit_api_request_async(url)
+
+
+def get_current_hour_floor():
+    """
+    :rtype: datetime.datetime
+    :returns: The start of the current hour.
+    """
+    return datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
 
 
 def get_subreddit_metric_labels(subreddit_name):
@@ -44,3 +399,54 @@ def get_subreddit_metric_labels(subreddit_name):
     return {'subreddit': subreddit_name}
 
 
+def get_unsent_subreddits(metrics, subreddit_names, point_time):
+    """
+    Lets a retried scan skip the sub-Reddits it already sent stats for.
+
+    :param list metrics: The metrics that the scan sends for each
+        sub-Reddit.
+    :param list subreddit_names: The sub-Reddits being scanned.
+    :param datetime.datetime point_time: The time the scan reports for.
+    :rtype: list
+    :returns: The sub-Reddits that are missing a point for any of the
+        metrics, in their original order.
+    """
+    labels_list = [get_subreddit_metric_labels(name)
+                   for name in subreddit_names]
+    unsent_names = set()
+    for metric in metrics:
+        points_written = metric.are_points_written(labels_list, point_time)
+        unsent_names.update(
+            name for name, is_written in zip(subreddit_names, points_written)
+            if not is_written)
+    return [name for name in subreddit_names if name in unsent_names]
+
+
+def decode_listing(json_str, item_fields):
+    """
+    Decodes a Reddit listing, keeping only the requested fields of each
+    child. The whole page is decoded first, so this doesn't save any CPU
+    or peak memory over ``json.loads``. It only keeps what we hold on to
+    afterwards (IE: the watermark posts) small.
+
+    :param str json_str: The raw listing JSON.
+    :param list item_fields: Top-level fields to pull out of each child's
+        'data' object.
+    :rtype: tuple
+    :return: Tuple in the form of: items, after. ``items`` is a list of
+        dicts in listing order, only containing ``item_fields``.
+    """
+    listing = json.loads(json_str)['data']
+    items = [project_fields(child['data'], item_fields)
+             for child in listing['children']]
+    return items, listing.get('after')
+
+
+def project_fields(obj, fields):
+    """
+    :param dict obj: A decoded JSON object.
+    :param list fields: The keys to keep.
+    :rtype: dict
+    :return: A dict with only the ``fields`` that ``obj`` has.
+    """
+    return {field: obj[field] for field in fields if field in obj}
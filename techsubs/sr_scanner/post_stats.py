@@ -2,12 +2,45 @@
 This module contains everything needed to calculate and send stats about
 the posts on a sub-Reddit. For example, new posts over time.
 """
-import json
+import logging
 import datetime
 
-from techsubs.metrics.metric_defines import SubRedditNewPostCount
+from google.appengine.api import memcache
+from google.appengine.api import urlfetch
+
+from techsubs.exceptions import RedditAPIError
+from techsubs.metrics.common import MetricBatch
+from techsubs.metrics.metric_defines import SubRedditNewPostCount, \
+    SubRedditNewPostComments, SubRedditNewPostScoreSum, \
+    SubRedditNewPostScoreMax, SubRedditNewPostScoreDistribution, \
+    SubRedditNewSelfPostCount
+from techsubs.models import SubredditPostWatermark
 from techsubs.sr_scanner.common import get_subreddit_metric_labels, \
-    send_reddit_api_request
+    estimate_listing_page_size, get_unsent_subreddits, ListingIterator, \
+    REDDIT_LISTING_MAX_LIMIT, REDDIT_MAX_CONCURRENT_REQUESTS
+from techsubs.utils import chunked
+
+# When packing sub-Reddits into a shared multi-reddit listing, only plan on
+# filling this much of the page. Post volume is bursty, and an overflowing
+# shared listing costs us one extra request per member.
+SHARED_LISTING_FILL_RATIO = 0.5
+# Keeps multi-reddit URLs to a sane length.
+MAX_SUBREDDITS_PER_SHARED_LISTING = 50
+# A shared listing that needs more pages than this gets split up.
+SHARED_LISTING_MAX_PAGES = 2
+# Hourly post volume to assume for sub-Reddits we haven't scanned yet.
+DEFAULT_HOURLY_POST_VOLUME = 5
+# Memcache key prefix for the last observed hourly post volume.
+POST_VOLUME_KEY_PREFIX = 'sr-post-volume:'
+# Watermarks older than this (relative to the window start) aren't worth
+# following forward. We'd page through more posts than a normal scan would.
+WATERMARK_MAX_AGE = datetime.timedelta(hours=6)
+# The metrics every scanned sub-Reddit gets a point for.
+POST_STATS_METRICS = [
+    SubRedditNewPostCount, SubRedditNewPostComments, SubRedditNewPostScoreSum,
+    SubRedditNewPostScoreMax, SubRedditNewPostScoreDistribution,
+    SubRedditNewSelfPostCount,
+]
 
 
 def calc_and_send_subreddit_post_stats(subreddit_name):
@@ -18,48 +51,348 @@ def calc_and_send_subreddit_post_stats(subreddit_name):
 
     Assumptions:
 
-    * We run this once per hour. Running this more than once will cause
-      the post-related stats to fail, since Google Metrics errors out instead
-      of idempotently allowing updates.
+    * We run this once per hour. Running it again for the same hour (say,
+      a task retry) skips any sub-Reddits whose stats were already sent,
+      so we don't hit Reddit or Google Metrics for them twice.
     * All of the hour's previous posts are accounted for in the JSON response.
       Keep in mind that un-auth'd requests to /new/.json are cached by
       the CDN for some length of time.
 
     :param str subreddit_name: The sub-Reddit to make post stats for.
     """
-    prev_hour = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
-    hour_floor = prev_hour.replace(minute=0, second=0, microsecond=0)
-    hour_ceil = prev_hour.replace(minute=59, second=59, microsecond=999999)
-    new_posts = _calc_subreddit_post_stats(subreddit_name, hour_floor, hour_ceil)
+    calc_and_send_subreddit_post_stats_batch([subreddit_name])
+
+
+def calc_and_send_subreddit_post_stats_batch(subreddit_names):
+    """
+    Same as :py:func:`calc_and_send_subreddit_post_stats`, but packs
+    low-volume sub-Reddits into shared multi-reddit listings
+    (/r/a+b+c/new/.json) so that a batch needs far fewer Reddit API requests.
+    Busy sub-Reddits automatically get a request of their own.
+
+    :param list subreddit_names: The sub-Reddits to make post stats for.
+    :raises: MetricWriteError if any of the points failed to write.
+    """
+    hour_floor, hour_ceil = _get_prev_hour_window()
+    subreddit_names = get_unsent_subreddits(
+        POST_STATS_METRICS, subreddit_names, hour_floor)
+    if not subreddit_names:
+        return
+    window_stats = _calc_subreddit_post_stats_batch(
+        subreddit_names, hour_floor, hour_ceil)
+    _remember_post_volumes(
+        {name: stats.new_posts for name, stats in window_stats.items()})
+
+    with MetricBatch() as metric_batch:
+        for subreddit_name in subreddit_names:
+            if subreddit_name not in window_stats:
+                # Its listing failed. It was already logged.
+                continue
+            _send_post_window_stats(
+                subreddit_name, window_stats[subreddit_name], hour_floor)
+    metric_batch.raise_for_errors()
+    # Only move the watermarks once the points are safely written.
+    SubredditPostWatermark.set_for_subreddits(
+        {name: stats.newest_post for name, stats in window_stats.items()
+         if stats.newest_post})
+
 
+def _send_post_window_stats(subreddit_name, stats, hour_floor):
+    """
+    :param str subreddit_name: The sub-Reddit to send post stats for.
+    :param PostWindowStats stats: The sub-Reddit's stats for the window.
+    :param datetime.datetime hour_floor: The hour to report the stats for.
+    """
     metric_labels = get_subreddit_metric_labels(subreddit_name)
     # time_override is specified so that we can't double-report an hour.
     SubRedditNewPostCount.write_gauge(
-        new_posts, labels=metric_labels, time_override=hour_floor)
+        stats.new_posts, labels=metric_labels, time_override=hour_floor)
+    SubRedditNewPostComments.write_gauge(
+        stats.comments, labels=metric_labels, time_override=hour_floor)
+    SubRedditNewPostScoreSum.write_gauge(
+        stats.score_sum, labels=metric_labels, time_override=hour_floor)
+    SubRedditNewPostScoreMax.write_gauge(
+        stats.score_max, labels=metric_labels, time_override=hour_floor)
+    SubRedditNewPostScoreDistribution.write_gauge(
+        stats.score_distribution, labels=metric_labels,
+        time_override=hour_floor)
+    SubRedditNewSelfPostCount.write_gauge(
+        stats.self_posts, labels=metric_labels, time_override=hour_floor)
 
 
-def _calc_subreddit_post_stats(subreddit_name, start_time, end_time):
+class PostWindowStats(object):
     """
-    Calculates some hourly post stats for the sub-reddit. This is always
-    an hour behind, to make sure that we have the full hour's worth of posts.
+    Accumulates stats for one sub-Reddit's posts within a window. Everything
+    is computed in a single pass over posts that we already had to fetch
+    to count them, so these cost us no extra Reddit API requests.
+    """
+    def __init__(self):
+        self.new_posts = 0
+        self.comments = 0
+        self.score_sum = 0
+        self.score_max = 0
+        self.score_distribution = \
+            SubRedditNewPostScoreDistribution.create_distribution()
+        self.self_posts = 0
+        # The newest post 'data' dict seen, for watermarking.
+        self.newest_post = None
 
-    :param str subreddit_name: The sub-Reddit to make post stats for.
-    :param datetime.datetime start_time: Only consider posts that happened after
-        this time.
-    :param datetime.datetime start_time: Only consider posts that happened before
-        this time.
-    :rtype: int
-    :return: The number of new posts for the given time range.
-    """
-    url = 'https://www.reddit.com/r/{}/new/.json?limit=100'.format(subreddit_name)
-    result_json = send_reddit_api_request(url).content
-    result = json.loads(result_json)
-    post_containers = result['data']['children']
-
-    counter = 0
-    for post_container in post_containers:
-        post = post_container['data']
+    def add_post(self, post):
+        """
+        :param dict post: A post 'data' dict that falls within the window.
+        """
+        score = int(post['score'])
+        if not self.new_posts or score > self.score_max:
+            self.score_max = score
+        self.new_posts += 1
+        self.comments += int(post['num_comments'])
+        self.score_sum += score
+        self.score_distribution.add(score)
+        if post['is_self']:
+            self.self_posts += 1
+        if self.newest_post is None or \
+                post['created_utc'] > self.newest_post['created_utc']:
+            self.newest_post = post
+
+
+def _get_prev_hour_window():
+    """
+    :rtype: tuple
+    :returns: Tuple in the form of: hour_floor, hour_ceil for the previous
+        hour (UTC).
+    """
+    prev_hour = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+    hour_floor = prev_hour.replace(minute=0, second=0, microsecond=0)
+    hour_ceil = prev_hour.replace(minute=59, second=59, microsecond=999999)
+    return hour_floor, hour_ceil
+
+
+def _get_hours_to_cover(start_time):
+    """
+    :param datetime.datetime start_time: The start of the window being
+        counted.
+    :rtype: float
+    :returns: How many hours of posts a /new listing has to reach back
+        through to get to ``start_time``.
+    """
+    return max(
+        (datetime.datetime.utcnow() - start_time).total_seconds() / 3600.0, 1)
+
+
+def _calc_subreddit_post_stats_batch(subreddit_names, start_time, end_time):
+    """
+    Calculates hourly post stats for a batch of sub-Reddits. Quiet ones
+    share listings, and up to
+    :py:data:`techsubs.sr_scanner.common.REDDIT_MAX_CONCURRENT_REQUESTS`
+    listings are fetched at once.
+
+    :param list subreddit_names: The sub-Reddits to make post stats for.
+    :param datetime.datetime start_time: Only consider posts that happened
+        after this time.
+    :param datetime.datetime start_time: Only consider posts that happened
+        before this time.
+    :rtype: dict
+    :return: A dict of sub-Reddit names to :py:class:`PostWindowStats`.
+    """
+    window_stats = {}
+    expected_volumes = _get_expected_posts(subreddit_names, start_time)
+    watermarks = SubredditPostWatermark.get_for_subreddits(subreddit_names)
+    listing_groups = _pack_subreddits_into_listings(
+        subreddit_names, expected_volumes)
+
+    shared_groups = [group for group in listing_groups if len(group) > 1]
+    # Busy sub-Reddits, plus the members of any shared listings that
+    # overflow, get a listing of their own.
+    solo_names = [group[0] for group in listing_groups if len(group) == 1]
+
+    for groups_chunk in chunked(shared_groups, REDDIT_MAX_CONCURRENT_REQUESTS):
+        listings = [
+            (group, _make_shared_listing(
+                group, start_time,
+                sum(expected_volumes[name] for name in group)))
+            for group in groups_chunk]
+        for group, listing in listings:
+            listing.prefetch()
+        for group, listing in listings:
+            group_stats = _tally_listing_posts(
+                listing, group, start_time, end_time)
+            if group_stats is None or not listing.complete:
+                # Either one of the members broke the listing, or we ran
+                # out of pages before reaching the start of the window.
+                # The solo listings sort out which, and the volumes they
+                # find will split this group up on the next packing pass.
+                solo_names.extend(group)
+                continue
+            window_stats.update(group_stats)
+
+    for names_chunk in chunked(solo_names, REDDIT_MAX_CONCURRENT_REQUESTS):
+        listings = [
+            (name, _make_subreddit_listing(
+                name, start_time, expected_volumes[name],
+                watermark=watermarks.get(name)))
+            for name in names_chunk]
+        for name, listing in listings:
+            listing.prefetch()
+        for name, listing in listings:
+            solo_stats = _tally_listing_posts(
+                listing, [name], start_time, end_time)
+            if solo_stats is not None:
+                window_stats.update(solo_stats)
+    return window_stats
+
+
+def _tally_listing_posts(listing, subreddit_names, start_time, end_time):
+    """
+    Same as :py:func:`_tally_window_posts`, but a listing that Reddit
+    won't hand over (IE: a sub-Reddit that went private or got banned) is
+    logged and skipped, rather than failing the whole batch.
+
+    :rtype: dict or None
+    :return: A dict of sub-Reddit names to :py:class:`PostWindowStats`, or
+        None if the listing couldn't be fetched.
+    """
+    try:
+        return _tally_window_posts(
+            listing, subreddit_names, start_time, end_time)
+    except (RedditAPIError, urlfetch.Error):
+        logging.exception(
+            "Failed to list new posts for: %s", listing.subreddit_path)
+        return None
+
+
+def _make_subreddit_listing(subreddit_name, start_time, expected_posts,
+                            watermark=None):
+    """
+    :param str subreddit_name: The sub-Reddit to list new posts for.
+    :param datetime.datetime start_time: The start of the window being
+        counted. The listing needs to reach back this far.
+    :param float expected_posts: How many posts we expect the listing to
+        need to cover. Used to size the first page.
+    :param SubredditPostWatermark watermark: If we've scanned this
+        sub-Reddit recently, only ask Reddit for posts newer than this.
+    :rtype: ListingIterator
+    """
+    since_fullname = None
+    # A watermark inside the window means we've counted it before (IE: this
+    # is a retry). Start from scratch so we don't undercount.
+    if watermark and start_time - WATERMARK_MAX_AGE <= \
+            watermark.created_time < start_time:
+        since_fullname = watermark.fullname
+    return ListingIterator(
+        subreddit_name, start_time,
+        page_size=estimate_listing_page_size(expected_posts),
+        since_fullname=since_fullname)
+
+
+def _make_shared_listing(subreddit_names, start_time, expected_posts):
+    """
+    :param list subreddit_names: The sub-Reddits sharing the listing.
+    :param datetime.datetime start_time: The start of the window being
+        counted. The listing needs to reach back this far.
+    :param float expected_posts: How many posts we expect the listing to
+        need to cover. Used to size the first page.
+    :rtype: ListingIterator
+    """
+    return ListingIterator(
+        '+'.join(subreddit_names), start_time,
+        page_size=estimate_listing_page_size(expected_posts),
+        max_pages=SHARED_LISTING_MAX_PAGES)
+
+
+def _tally_window_posts(posts, subreddit_names, start_time, end_time):
+    """
+    Tallies up stats for the posts that fall within the window, grouped by
+    sub-Reddit.
+
+    :param iterable posts: Post 'data' dicts.
+    :param list subreddit_names: The sub-Reddits to count posts for. Posts
+        from any others are ignored.
+    :param datetime.datetime start_time: Only consider posts that happened
+        after this time.
+    :param datetime.datetime start_time: Only consider posts that happened
+        before this time.
+    :rtype: dict
+    :return: A dict of sub-Reddit names to :py:class:`PostWindowStats`.
+    """
+    # Reddit hands back the canonical capitalization, which doesn't
+    # always match what is in our catalog.
+    names_by_lower = {name.lower(): name for name in subreddit_names}
+    window_stats = {name: PostWindowStats() for name in subreddit_names}
+    for post in posts:
         post_time = datetime.datetime.utcfromtimestamp(post['created_utc'])
-        if start_time <= post_time <= end_time:
-            counter += 1
-    return counter
+        subreddit_name = names_by_lower.get(post['subreddit'].lower())
+        if not subreddit_name or not start_time <= post_time <= end_time:
+            continue
+        window_stats[subreddit_name].add_post(post)
+    return window_stats
+
+
+def _pack_subreddits_into_listings(subreddit_names, expected_volumes):
+    """
+    Greedily packs sub-Reddits into listing groups based on their last
+    observed hourly post volume. Sub-Reddits that are too busy to share a
+    page end up in a group of their own.
+
+    :param list subreddit_names: The sub-Reddits to pack.
+    :param dict expected_volumes: A dict of sub-Reddit names to the number
+        of posts we expect their listing to need to cover.
+    :rtype: list
+    :return: A list of lists of sub-Reddit names.
+    """
+    page_budget = REDDIT_LISTING_MAX_LIMIT * SHARED_LISTING_FILL_RATIO
+
+    groups = []
+    current_group = []
+    current_fill = 0
+    for subreddit_name in subreddit_names:
+        expected_posts = expected_volumes[subreddit_name]
+        if expected_posts > page_budget:
+            groups.append([subreddit_name])
+            continue
+        if current_group and (
+                current_fill + expected_posts > page_budget or
+                len(current_group) >= MAX_SUBREDDITS_PER_SHARED_LISTING):
+            groups.append(current_group)
+            current_group = []
+            current_fill = 0
+        current_group.append(subreddit_name)
+        current_fill += expected_posts
+    if current_group:
+        groups.append(current_group)
+    return groups
+
+
+def _get_expected_posts(subreddit_names, start_time):
+    """
+    :param list subreddit_names: The sub-Reddits to look up.
+    :param datetime.datetime start_time: The start of the window being
+        counted. The listing needs to reach back this far.
+    :rtype: dict
+    :return: A dict of sub-Reddit names to the number of posts we expect
+        their /new listing to need to cover.
+    """
+    hours_to_cover = _get_hours_to_cover(start_time)
+    volumes = _get_post_volume_estimates(subreddit_names)
+    return {name: volume * hours_to_cover
+            for name, volume in volumes.items()}
+
+
+def _get_post_volume_estimates(subreddit_names):
+    """
+    :param list subreddit_names: The sub-Reddits to look up.
+    :rtype: dict
+    :return: A dict of sub-Reddit names to their last observed hourly post
+        volume, falling back to :py:data:`DEFAULT_HOURLY_POST_VOLUME`.
+    """
+    cached = memcache.get_multi(
+        subreddit_names, key_prefix=POST_VOLUME_KEY_PREFIX)
+    return {name: cached.get(name, DEFAULT_HOURLY_POST_VOLUME)
+            for name in subreddit_names}
+
+
+def _remember_post_volumes(post_counts):
+    """
+    :param dict post_counts: A dict of sub-Reddit names to hourly post counts.
+    """
+    memcache.set_multi(post_counts, key_prefix=POST_VOLUME_KEY_PREFIX)
+
@@ -0,0 +1,162 @@
+"""
+A shared, header-driven rate limiter for the Reddit API. Every Reddit request
+we send goes through :py:func:`acquire_reddit_request_slot` first.
+
+Reddit tells us how much of our budget is left with each response
+(X-Ratelimit-Remaining), and how many seconds until it resets
+(X-Ratelimit-Reset). We keep that in memcache so that all instances see the
+same picture, then spread the remaining requests evenly over the rest of the
+window. If we get a 429 anyway, everyone backs off until Retry-After passes.
+"""
+import time
+import random
+
+from google.appengine.api import memcache
+
+# What we assume the budget looks like until Reddit tells us otherwise.
+# Un-authenticated clients get 30 requests per minute.
+DEFAULT_REQUESTS_PER_WINDOW = 30
+DEFAULT_WINDOW_SECONDS = 60
+# Hold back a few requests from what Reddit says we have left, to make up
+# for requests that are in flight on other instances.
+REMAINING_SAFETY_MARGIN = 2
+# How many requests may go out back to back before pacing kicks in. Lets a
+# worker get its concurrent fetches in flight together.
+BURST_SIZE = 4
+# Back-off to use after a 429 that didn't come with a Retry-After.
+RATE_LIMITED_BASE_BACKOFF = 10
+# Never sleep for longer than this at a time, so we re-check the shared
+# state regularly.
+MAX_SLEEP_SECONDS = 10
+# Give up on a memcache compare-and-set after this many collisions.
+MAX_CAS_ATTEMPTS = 10
+
+RATE_LIMIT_STATE_KEY = 'reddit-rate-limit-state'
+# Long enough to outlive any reset window.
+RATE_LIMIT_STATE_TTL = 3600
+
+
+def acquire_reddit_request_slot():
+    """
+    Blocks until we're allowed to send another request to Reddit, then
+    claims it.
+    """
+    while True:
+        wait = _update_state(_claim_slot)
+        if not wait:
+            return
+        time.sleep(min(wait, MAX_SLEEP_SECONDS))
+
+
+def update_rate_limit_from_headers(headers):
+    """
+    :param dict headers: The response headers from a Reddit API request.
+    """
+    remaining = headers.get('x-ratelimit-remaining')
+    reset = headers.get('x-ratelimit-reset')
+    if remaining is None or reset is None:
+        return
+    remaining = float(remaining)
+    reset_at = time.time() + float(reset)
+
+    def apply_headers(state, now):
+        state['remaining'] = max(remaining - REMAINING_SAFETY_MARGIN, 0)
+        state['reset_at'] = reset_at
+    _update_state(apply_headers)
+
+
+def back_off_after_rate_limit(retry_after, attempt):
+    """
+    Stops all instances from sending Reddit requests for a while. Call this
+    after getting a 429.
+
+    :param float retry_after: The response's Retry-After, in seconds. May
+        be None if it wasn't sent.
+    :param int attempt: How many times this request has already been
+        rate limited. Used for exponential back-off.
+    """
+    backoff = RATE_LIMITED_BASE_BACKOFF * (2 ** attempt)
+    if retry_after is not None:
+        backoff = max(backoff, retry_after)
+    # Jitter, so that the workers that were waiting don't all stampede back
+    # at the same instant.
+    blocked_until = time.time() + backoff * random.uniform(1.0, 1.5)
+
+    def apply_backoff(state, now):
+        state['blocked_until'] = max(state['blocked_until'], blocked_until)
+    _update_state(apply_backoff)
+
+
+def _claim_slot(state, now):
+    """
+    :param dict state: The shared rate limit state. Modified in place if a
+        slot is claimed.
+    :param float now: The current time.
+    :rtype: float
+    :returns: 0 if a slot was claimed, otherwise the number of seconds to
+        wait before trying again.
+    """
+    if state['blocked_until'] > now:
+        return state['blocked_until'] - now
+    if state['remaining'] < 1:
+        return max(state['reset_at'] - now, 0.1)
+
+    spacing = (state['reset_at'] - now) / state['remaining']
+    next_request_at = max(state['next_request_at'], now - spacing * BURST_SIZE)
+    if next_request_at > now:
+        return next_request_at - now
+    state['remaining'] -= 1
+    state['next_request_at'] = next_request_at + spacing
+    return 0
+
+
+def _get_default_state(now):
+    """
+    :param float now: The current time.
+    :rtype: dict
+    :returns: Rate limit state for a fresh window, before Reddit has told us
+        anything.
+    """
+    return {
+        'remaining': DEFAULT_REQUESTS_PER_WINDOW,
+        'reset_at': now + DEFAULT_WINDOW_SECONDS,
+        'next_request_at': 0,
+        'blocked_until': 0,
+    }
+
+
+def _update_state(update_func):
+    """
+    Atomically reads, modifies, and writes back the shared rate limit state.
+
+    :param callable update_func: Called with the state dict and the current
+        time. It modifies the dict in place, and its return value is passed
+        through.
+    :returns: Whatever ``update_func`` returned.
+    """
+    client = memcache.Client()
+    for _ in range(MAX_CAS_ATTEMPTS):
+        now = time.time()
+        state = client.gets(RATE_LIMIT_STATE_KEY)
+        if state is None:
+            new_state = _get_default_state(now)
+        else:
+            new_state = dict(state)
+            if new_state['reset_at'] <= now:
+                # Reddit's window rolled over without us hearing about it.
+                new_state.update(
+                    remaining=DEFAULT_REQUESTS_PER_WINDOW,
+                    reset_at=now + DEFAULT_WINDOW_SECONDS)
+        retval = update_func(new_state, now)
+
+        if state is None:
+            stored = client.add(
+                RATE_LIMIT_STATE_KEY, new_state, time=RATE_LIMIT_STATE_TTL)
+        else:
+            stored = client.cas(
+                RATE_LIMIT_STATE_KEY, new_state, time=RATE_LIMIT_STATE_TTL)
+        if stored:
+            return retval
+    # Memcache is either very busy or unavailable. Rather than stall the
+    # scanners, go with what we computed. Reddit will 429 us if we're wrong.
+    return retval
@@ -0,0 +1,14 @@
+"""
+Small helpers that don't belong to any one part of the app.
+"""
+
+
+def chunked(items, chunk_size):
+    """
+    :param list items: The list to break up.
+    :param int chunk_size: The max number of items per chunk.
+    :rtype: generator
+    :return: A generator of lists, each no longer than ``chunk_size``.
+    """
+    for i in range(0, len(items), chunk_size):
+        yield items[i:i + chunk_size]
@@ -10,3 +10,11 @@ def subreddit_category_overview(subreddit_category):
     # noinspection PyProtectedMember
     json = category_overview._generate_json(subreddit_category)
     return flask.Response(json, content_type='application/json')
+
+
+@app.route('/api/subreddits/overview',
+           endpoint='api-all-subreddits-overview')
+def all_subreddits_overview():
+    # noinspection PyProtectedMember
+    json = category_overview._generate_all_json()
+    return flask.Response(json, content_type='application/json')
@@ -1,3 +1,4 @@
 # Import all view-related sub-modules from here to make sure they get
 # registered at start time.
 from techsubs.views.cron import subreddits  # noqa
+from techsubs.views.cron import metrics  # noqa
@@ -0,0 +1,13 @@
+from techsubs import app
+from techsubs.metrics import ledger
+
+
+@app.route('/_cron/metrics/prune-point-ledger')
+def prune_metric_point_ledger():
+    """
+    Clears out metric point ledger entries that are too old to matter.
+    """
+    pruned = ledger.prune_ledger()
+    while pruned == ledger.PRUNE_BATCH_SIZE:
+        pruned = ledger.prune_ledger()
+    return "OK"
@@ -1,15 +1,13 @@
 from techsubs import app
-from techsubs.metrics.common import BaseMetric
+from techsubs.metrics import metric_defines  # noqa
+from techsubs.metrics.common import sync_metric_descriptors
 
 
 def _setup_metrics():
     """
-    Makes sure all of the metrics are defined.
+    Makes sure all of the metrics are defined, and up to date.
     """
-    metric_types = BaseMetric.__subclasses__()
-    for metric_type in metric_types:
-        for metric in metric_type.__subclasses__():
-            metric.create_metric()
+    sync_metric_descriptors()
 
 
 @app.route('/_system/setup/all')
@@ -20,3 +18,13 @@ def setup_all_the_things():
     """
     _setup_metrics()
     return "OK"
+
+
+@app.route('/_ah/warmup')
+def warmup():
+    """
+    App Engine calls this as new instances start up. Only the metrics that
+    are missing or changed cost a Google Metrics call, so this is cheap.
+    """
+    _setup_metrics()
+    return "OK"
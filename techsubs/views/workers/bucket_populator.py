@@ -2,7 +2,6 @@ import flask
 from google.appengine.api import taskqueue
 
 from techsubs import app
-from techsubs import subreddits
 from techsubs.bucket_populator import category_overview
 
 
@@ -11,12 +10,22 @@ from techsubs.bucket_populator import category_overview
 def enqueue_all_overview_json_population():
     """
     Initiates a full generation and upload of all Subreddit category
-    index overview JSON documents.
+    index overview JSON documents. They're all done by a single task, so
+    that sub-Reddits in several categories only get queried once.
     """
-    for category in subreddits.CATEGORIES.keys():
-        gen_worker = flask.url_for(
-            'json-category-overview-json', category=category)
-        taskqueue.add(url=gen_worker, queue_name='bucket-populator-workers')
+    gen_worker = flask.url_for('json-all-overviews-json')
+    taskqueue.add(url=gen_worker, queue_name='bucket-populator-workers')
+    return "OK"
+
+
+@app.route('/_workers/static-gen/overview/all/json',
+           endpoint='json-all-overviews-json', methods=['POST'])
+def gen_and_upload_all_overview_json():
+    """
+    Generates and uploads every Subreddit category's overview JSON, plus
+    the overview JSON for all Subreddits.
+    """
+    category_overview.generate_and_upload_all()
     return "OK"
 
 
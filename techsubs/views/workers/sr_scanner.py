@@ -4,21 +4,67 @@ from google.appengine.api import taskqueue
 from techsubs import app
 from techsubs import subreddits
 from techsubs import sr_scanner
+from techsubs.bucket_populator.common import enqueue_debounced_population
+from techsubs.sr_scanner.basic_stats import is_sampling_accounts_active
+from techsubs.sr_scanner.common import REDDIT_INFO_MAX_NAMES
+from techsubs.utils import chunked
+
+# Worst case, every sub-Reddit in a post stats batch needs its own request.
+# Keep this small enough that a single task comfortably finishes within its
+# deadline, even when the rate limiter has it waiting.
+POST_STATS_BATCH_SIZE = 25
+# Combined scans are dominated by their post stats work, so they're sized
+# the same way.
+COMBINED_SCAN_BATCH_SIZE = POST_STATS_BATCH_SIZE
+# Each active account sampling task needs only the one info request.
+ACCOUNTS_ACTIVE_SAMPLE_BATCH_SIZE = REDDIT_INFO_MAX_NAMES
 
 
 @app.route('/_workers/sr_scanner/enqueue-all', endpoint='sr-scanner-enqueue-all')
 def enqueue_all_subreddit_scans():
     """
-    Initiates a full scan of the sub-Reddits. We enqueue these separately so
-    that each scanner worker only hits the Reddit API once, and the task queue
-    makes sure only one worker is running at a time. End result is that we stay
-    under rate limits.
+    Initiates a full scan of the sub-Reddits. The work is broken up into
+    batches, and every Reddit request the workers make goes through our
+    shared rate limiter. End result is that we stay under rate limits.
     """
-    for subreddit in subreddits.CATALOG.keys():
-        basic_stats = flask.url_for('sr-scanner-basic-stats', subreddit=subreddit)
-        taskqueue.add(url=basic_stats, queue_name='subreddit-api-workers')
-        post_stats = flask.url_for('sr-scanner-post-stats', subreddit=subreddit)
-        taskqueue.add(url=post_stats, queue_name='subreddit-api-workers')
+    subreddit_names = list(subreddits.CATALOG.keys())
+    # Each of these tasks covers every metric for a whole batch of
+    # sub-Reddits.
+    for names_chunk in chunked(subreddit_names, COMBINED_SCAN_BATCH_SIZE):
+        combined_scan = flask.url_for('sr-scanner-combined-batch')
+        taskqueue.add(url=combined_scan, queue_name='subreddit-api-workers',
+                      params={'subreddits': ','.join(names_chunk)})
+    return "OK"
+
+
+@app.route('/_workers/sr_scanner/sample-active/enqueue-all',
+           endpoint='sr-scanner-sample-active-enqueue-all')
+def enqueue_all_accounts_active_samples():
+    """
+    Takes an active account sample for every sub-Reddit, if sampling is on.
+    This is run far more often than the full scans, so each sub-Reddit's
+    hourly peak is closer to the real thing.
+    """
+    if not is_sampling_accounts_active():
+        return "Sampling is off."
+    subreddit_names = list(subreddits.CATALOG.keys())
+    for names_chunk in chunked(
+            subreddit_names, ACCOUNTS_ACTIVE_SAMPLE_BATCH_SIZE):
+        sample_active = flask.url_for('sr-scanner-sample-active-batch')
+        taskqueue.add(url=sample_active, queue_name='subreddit-api-workers',
+                      params={'subreddits': ','.join(names_chunk)})
+    return "OK"
+
+
+@app.route('/_workers/sr_scanner/batch/sample-active',
+           endpoint='sr-scanner-sample-active-batch', methods=['POST'])
+def sample_accounts_active_batch():
+    """
+    Samples active accounts for a comma-separated batch of sub-Reddits,
+    passed in via the 'subreddits' form value.
+    """
+    subreddit_names = flask.request.form['subreddits'].split(',')
+    sr_scanner.sample_accounts_active_batch(subreddit_names)
     return "OK"
 
 
@@ -33,6 +79,19 @@ def scan_subreddit_basic_stats(subreddit):
     return "OK"
 
 
+@app.route('/_workers/sr_scanner/batch/basic',
+           endpoint='sr-scanner-basic-stats-batch', methods=['POST'])
+def scan_subreddit_basic_stats_batch():
+    """
+    Scans basic stats for a comma-separated batch of sub-Reddits, passed
+    in via the 'subreddits' form value.
+    """
+    subreddit_names = flask.request.form['subreddits'].split(',')
+    sr_scanner.calc_and_send_basic_subreddit_stats_batch(subreddit_names)
+    enqueue_debounced_population()
+    return "OK"
+
+
 @app.route('/_workers/sr_scanner/single/<subreddit>',
            endpoint='sr-scanner-post-stats', methods=['POST'])
 def scan_subreddit_post_stats(subreddit):
@@ -41,3 +100,35 @@ def scan_subreddit_post_stats(subreddit):
     """
     sr_scanner.calc_and_send_subreddit_post_stats(subreddit)
     return "OK"
+
+
+@app.route('/_workers/sr_scanner/batch/posts',
+           endpoint='sr-scanner-post-stats-batch', methods=['POST'])
+def scan_subreddit_post_stats_batch():
+    """
+    Calculates post activity stats for a comma-separated batch of
+    sub-Reddits, passed in via the 'subreddits' form value.
+    """
+    subreddit_names = flask.request.form['subreddits'].split(',')
+    sr_scanner.calc_and_send_subreddit_post_stats_batch(subreddit_names)
+    enqueue_debounced_population()
+    return "OK"
+
+
+@app.route('/_workers/sr_scanner/batch/combined',
+           endpoint='sr-scanner-combined-batch', methods=['POST'])
+def scan_subreddit_combined_stats_batch():
+    """
+    Calculates every stat we track for a comma-separated batch of
+    sub-Reddits, passed in via the 'subreddits' form value.
+    """
+    subreddit_names = flask.request.form['subreddits'].split(',')
+    failed_metrics = sr_scanner.calc_and_send_combined_subreddit_stats(
+        subreddit_names)
+    # Whatever did get sent should show up on the site right away.
+    enqueue_debounced_population()
+    if failed_metrics:
+        # Fail the task so the queue retries it. The points that did make
+        # it are in the ledger, so the retry skips them.
+        return "Partial failure: %s" % ', '.join(failed_metrics), 500
+    return "OK"